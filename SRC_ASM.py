@@ -1,12 +1,59 @@
+import os
 import re
+import bisect
+import sys
+import glob
+import json
+import hashlib
+import time
 import argparse
+import operator
+import tempfile
+import threading
 import traceback
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import repeat
+from types import MappingProxyType
+from typing import Callable, Iterable, Iterator, NamedTuple
 
 
 class InvalidInstructionParsed(Exception):
     pass
 
 
+# stops the preprocessor even when it keeps going after other errors
+class ProgramTooLarge(InvalidInstructionParsed):
+    pass
+
+
+# a preprocessor error whose message already says which file and line or
+# macro it came from, so the lines that included it don't say it again
+class LocatedError(InvalidInstructionParsed):
+    pass
+
+
+# words of memory in the Mini SRC used in the labs, can be changed per program
+DEFAULT_MEMORY_DEPTH = 512
+
+# annotated memory files, a source listing and a JSON source map, written
+# from the assembled program
+text_formats = ["mem", "mif", "lst", "map"]
+# raw binary, intel hex and packed $readmemh hex, written from the memory image
+image_formats = ["bin", "hex", "vhex"]
+output_formats = text_formats + image_formats
+# the formats that print source lines, the others can be assembled from a file
+# read one line at a time
+source_formats = ["lst", "map"]
+
+# array typecode of an unsigned 32 bit word on this platform
+WORD_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+
 register_mapping = {
     "t0": 0,
     "at": 1,  # modification of spec
@@ -43,17 +90,28 @@ register_mapping = {
     "r15": 15,
 }
 
+# register names of each ISA variant, the spec one doesn't have at
+isa_variants = {
+    "lab": register_mapping,
+    "spec": {name: number for name, number in register_mapping.items() if name != "at"},
+}
+# the register names used by the assembler running in this thread (see Assembler)
+register_names: ContextVar[dict[str, int]] = ContextVar(
+    "register_names", default=register_mapping)
+
+
+branch_c2_values = {
+    "brzr": 0b0000,
+    "brnz": 0b0001,
+    "brpl": 0b0010,
+    "brmi": 0b0011,
+}
+
 
 def get_c2_for_branch(branch_name: str) -> int:
-    c2_values = {
-        "brzr": 0b0000,
-        "brnz": 0b0001,
-        "brpl": 0b0010,
-        "brmi": 0b0011,
-    }
-    if branch_name not in c2_values.keys():
+    if branch_name not in branch_c2_values:
         raise InvalidInstructionParsed("invalid branch c2 value")
-    return c2_values[branch_name]
+    return branch_c2_values[branch_name]
 
 
 opcodes = {
@@ -100,39 +158,56 @@ reg = ["jal", "jr", "in", "out", "mflo", "mfhi"]
 no_args = ["nop", "halt"]
 
 
+# warnings are printed unless they are being collected (see collect_warnings),
+# which is per thread so concurrent requests don't see each other's
+collected_warnings: ContextVar[list[str] | None] = ContextVar(
+    "collected_warnings", default=None)
+
+
+def warn(message: str):
+    warnings = collected_warnings.get()
+    if warnings is None:
+        print(f"WARNING: {message}")
+    else:
+        warnings.append(message)
+
+
+@contextmanager
+def collect_warnings() -> Iterator[list[str]]:
+    warnings: list[str] = []
+    token = collected_warnings.set(warnings)
+    try:
+        yield warnings
+    finally:
+        collected_warnings.reset(token)
+
+
 def get_register_number(register_name: str) -> int:
-    if register_name.lower() not in register_mapping.keys():
+    register_number = register_names.get().get(register_name.lower())
+    if register_number is None:
         raise InvalidInstructionParsed(
             f"invalid register identifier: {register_name}")
 
-    return register_mapping[register_name.lower()]
-
+    return register_number
 
-def get_constant(constant_value: str, labels: dict[str, int], bit_width: int = 19) -> int:
-    is_signed = True
-
-    if constant_value in labels:
-        return labels[constant_value]
 
-    constant_value = constant_value.lower()
+constant_regex = re.compile(
+    r"^(?:0b(?P<binary>[10]+)|0x(?P<hex>[0-9a-f]+)|-\s*(?P<negative>[0-9]+)|(?P<decimal>[0-9]+))$")
+label_name_regex = re.compile(r"\w+")
 
-    if match := re.match(r"^0b(?P<number>[10]+)$", constant_value):
-        is_signed = False
-        value = int(match.groupdict()['number'], 2)
 
-    elif match := re.match(r"^0x(?P<number>[0-9a-f]+)$", constant_value):
-        is_signed = False
-        value = int(match.groupdict()['number'], 16)
+class ForwardLabels(dict):
+    """Label table of a single pass, names that aren't labels yet are recorded instead of failing"""
 
-    elif match := re.match(r"^-\s*(?P<number>[0-9]+)$", constant_value):
-        value = -int(match.groupdict()['number'], 10)
+    def __init__(self):
+        super().__init__()
+        # (label, label_base, bit_width) of every name used before it was defined,
+        # the label is None for an expression, which is encoded again instead
+        self.forward_references: list[tuple[str | None, int, int]] = []
 
-    elif match := re.match(r"^(?P<number>[0-9]+)$", constant_value):
-        value = int(match.groupdict()['number'], 10)
-    else:
-        raise InvalidInstructionParsed(
-            f"could not parse constant value: {constant_value}")
 
+# hex and binary constants are unsigned, decimal ones signed
+def check_constant_range(constant_value: str, value: int, bit_width: int, is_signed: bool) -> int:
     max_unsigned_value = 2**bit_width - 1
     max_signed_value = 2**(bit_width-1) - 1
     min_signed_value = -2**(bit_width-1)
@@ -146,8 +221,8 @@ def get_constant(constant_value: str, labels: dict[str, int], bit_width: int = 1
                                            value}) is above the maximum of {max_unsigned_value}")
         else:
             if value > max_signed_value:
-                print(f"WARNING: unsigned constant value {
-                      constant_value} will be treated as negative by CPU")
+                warn(f"unsigned constant value {
+                     constant_value} will be treated as negative by CPU")
             return value
 
     # value is signed
@@ -163,12 +238,273 @@ def get_constant(constant_value: str, labels: dict[str, int], bit_width: int = 1
     return value
 
 
+# a label's value is counted from label_base, which branches set to the next
+# instruction, and is only used as a forward reference. address is the value
+# of . in an expression
+def get_constant(constant_value: str, labels: dict[str, int], bit_width: int = 19, label_base: int = 0, address: int = 0) -> int:
+    is_signed = True
+
+    if constant_value in labels:
+        return labels[constant_value]
+
+    label = constant_value
+    constant_value = constant_value.lower()
+
+    match = constant_regex.match(constant_value)
+    if match is None:
+        if not label_name_regex.fullmatch(label):
+            return get_expression_value(label, labels, bit_width, label_base, address)
+        if isinstance(labels, ForwardLabels):
+            # the label may be defined further down, 0 is patched once it is
+            labels.forward_references.append((label, label_base, bit_width))
+            return 0
+        raise InvalidInstructionParsed(
+            f"could not parse constant value: {constant_value}")
+
+    binary, hexadecimal, negative, decimal = match.groups()
+    if binary is not None:
+        is_signed = False
+        value = int(binary, 2)
+    elif hexadecimal is not None:
+        is_signed = False
+        value = int(hexadecimal, 16)
+    elif negative is not None:
+        value = -int(negative, 10)
+    else:
+        value = int(decimal, 10)
+
+    return check_constant_range(constant_value, value, bit_width, is_signed)
+
+
+# an expression that works out to an address (a label or . give or take a
+# number) is counted from label_base like a label, a difference of two labels
+# is a distance and isn't. its value is checked like a hex constant if it has
+# a hex or binary number, and like a decimal one otherwise
+def get_expression_value(text: str, labels: dict[str, int], bit_width: int, label_base: int, address: int) -> int:
+    expression = parse_expression(text)
+    for label in expression.labels:
+        if label not in labels:
+            if isinstance(labels, ForwardLabels):
+                labels.forward_references.append((None, label_base, bit_width))
+                return 0
+            raise InvalidInstructionParsed(f"unknown label {label} in {text}")
+
+    value = expression.evaluate(labels, address)
+    if expression.is_address:
+        value -= label_base
+    return check_constant_range(text, value, bit_width, not expression.is_unsigned or value < 0)
+
+
+class Expression(NamedTuple):
+    """A parsed constant expression, evaluated with the labels and address of each use"""
+    evaluate: Callable[[dict[str, int], int], int]
+    labels: tuple[str, ...]
+    is_address: bool
+    is_unsigned: bool  # has a hex or binary number
+
+
+# a number, or a function of the labels and address for the parts that use them
+ExpressionNode = int | Callable[[dict[str, int], int], int]
+# a node and how many addresses it adds up to: 1 for a label, . or an address
+# give or take a number, 0 for a number or a difference of two addresses.
+# anything else done to an address isn't one any more
+ParsedNode = tuple[ExpressionNode, int]
+
+# how many addresses the result of each operator adds up to
+address_operators: dict[str, Callable[[int, int], int]] = {
+    "+": operator.add,
+    "-": operator.sub,
+}
+
+expression_token_regex = re.compile(
+    r"\s*(?:(?P<number>(?:0x[0-9a-f]+|0b[01]+|[0-9]+)(?!\w))|(?P<name>\w+|\.)|(?P<operator><<|>>|[-+*/&|()]))",
+    re.IGNORECASE)
+# longer expressions are parsed every time instead of being kept
+MAX_CACHED_EXPRESSION_LENGTH = 256
+# products and left shifts past this many bits can't fit in any field
+MAX_EXPRESSION_BITS = 64
+
+
+def check_expression_size(value: int) -> int:
+    if value.bit_length() > MAX_EXPRESSION_BITS:
+        raise InvalidInstructionParsed(
+            f"constant expression value {value} is too large")
+    return value
+
+
+def check_shift_count(count: int) -> int:
+    if not 0 <= count < 32:
+        raise InvalidInstructionParsed(
+            f"shift count {count} must be between 0 and 31")
+    return count
+
+
+def multiply(left: int, right: int) -> int:
+    return check_expression_size(left * right)
+
+
+def divide(dividend: int, divisor: int) -> int:
+    if divisor == 0:
+        raise InvalidInstructionParsed("division by zero in constant expression")
+    # rounds towards zero like div
+    quotient = abs(dividend) // abs(divisor)
+    return -quotient if (dividend < 0) != (divisor < 0) else quotient
+
+
+def shift_left(value: int, count: int) -> int:
+    return check_expression_size(value << check_shift_count(count))
+
+
+def shift_right(value: int, count: int) -> int:
+    return value >> check_shift_count(count)
+
+
+# by precedence, from the loosest, like C
+binary_operators: list[dict[str, Callable[[int, int], int]]] = [
+    {"|": operator.or_},
+    {"&": operator.and_},
+    {"<<": shift_left, ">>": shift_right},
+    {"+": operator.add, "-": operator.sub},
+    {"*": multiply, "/": divide},
+]
+
+# the halves of a 32 bit value, for building it from two constants
+expression_functions: dict[str, Callable[[int], int]] = {
+    "hi": lambda value: (value >> 16) & 0xFFFF,
+    "lo": lambda value: value & 0xFFFF,
+}
+
+
+def parse_number(number: str) -> int:
+    number = number.lower()
+    if number.startswith("0x"):
+        return int(number[2:], 16)
+    if number.startswith("0b"):
+        return int(number[2:], 2)
+    return int(number, 10)
+
+
+def as_function(node: ExpressionNode) -> Callable[[dict[str, int], int], int]:
+    if isinstance(node, int):
+        return lambda labels, address: node
+    return node
+
+
+def apply_function(function: Callable[[int], int], node: ExpressionNode) -> ExpressionNode:
+    if isinstance(node, int):
+        return function(node)
+    return lambda labels, address: function(node(labels, address))
+
+
+# parts without labels are worked out when parsing
+def combine(function: Callable[[int, int], int], left: ExpressionNode, right: ExpressionNode) -> ExpressionNode:
+    if isinstance(left, int):
+        if isinstance(right, int):
+            return function(left, right)
+        return lambda labels, address: function(left, right(labels, address))
+    if isinstance(right, int):
+        return lambda labels, address: function(left(labels, address), right)
+    return lambda labels, address: function(left(labels, address), right(labels, address))
+
+
+class ExpressionParser:
+    """Recursive descent parser of one constant expression"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.labels: list[str] = []
+        self.is_unsigned = False
+        # (kind, text) of every token, last one first
+        self.tokens: list[tuple[str, str]] = []
+        text = text.strip()
+        position = 0
+        while position < len(text):
+            token_match = expression_token_regex.match(text, position)
+            if token_match is None:
+                raise self.error()
+            self.tokens.append((token_match.lastgroup, token_match[token_match.lastgroup]))
+            position = token_match.end()
+        self.tokens.reverse()
+
+    def error(self) -> InvalidInstructionParsed:
+        return InvalidInstructionParsed(
+            f"could not parse constant value: {self.text.lower()}")
+
+    def parse(self) -> Expression:
+        node, addresses = self.parse_binary(0)
+        if self.tokens:
+            raise self.error()
+        return Expression(as_function(node), tuple(dict.fromkeys(self.labels)), addresses == 1, self.is_unsigned)
+
+    def parse_binary(self, level: int) -> ParsedNode:
+        if level == len(binary_operators):
+            return self.parse_unary()
+        operators = binary_operators[level]
+        node, addresses = self.parse_binary(level + 1)
+        while self.tokens and self.tokens[-1][1] in operators:
+            token = self.tokens.pop()[1]
+            right, right_addresses = self.parse_binary(level + 1)
+            node = combine(operators[token], node, right)
+            address_operator = address_operators.get(token)
+            addresses = address_operator(addresses, right_addresses) if address_operator is not None else 0
+        return node, addresses
+
+    def parse_unary(self) -> ParsedNode:
+        if not self.tokens:
+            raise self.error()
+        kind, token = self.tokens.pop()
+        if token == "-":
+            node, addresses = self.parse_unary()
+            return combine(operator.sub, 0, node), -addresses
+        if token == "(":
+            return self.parse_parenthesized()
+        if kind == "number":
+            self.is_unsigned = self.is_unsigned or token[:2].lower() in ("0x", "0b")
+            return parse_number(token), 0
+        if token == ".":
+            return (lambda labels, address: address), 1
+        if kind == "name":
+            if token in expression_functions and self.tokens and self.tokens[-1][1] == "(":
+                self.tokens.pop()
+                return apply_function(expression_functions[token], self.parse_parenthesized()[0]), 0
+            self.labels.append(token)
+            return (lambda labels, address: labels[token]), 1
+        raise self.error()
+
+    def parse_parenthesized(self) -> ParsedNode:
+        parsed = self.parse_binary(0)
+        if not self.tokens or self.tokens.pop()[1] != ")":
+            raise self.error()
+        return parsed
+
+
+# operands repeat a lot, within a program and across the programs of a term,
+# and don't depend on the labels until they are evaluated
+@lru_cache(maxsize=1 << 12)
+def parse_cached_expression(text: str) -> Expression:
+    return parse_uncached_expression(text)
+
+
+def parse_uncached_expression(text: str) -> Expression:
+    try:
+        return ExpressionParser(text).parse()
+    except RecursionError:
+        raise InvalidInstructionParsed(
+            f"constant expression {text[:40]}... is nested too deeply")
+
+
+def parse_expression(text: str) -> Expression:
+    if len(text) > MAX_CACHED_EXPRESSION_LENGTH:
+        return parse_uncached_expression(text)
+    return parse_cached_expression(text)
+
+
 def get_branch_offset(argument: str, labels: dict[str, int], instruction_number: int) -> int:
-    if argument in labels.keys():
+    if argument in labels:
         return (labels[argument] - 1) - instruction_number
 
     try:
-        return get_constant(argument, labels)
+        return get_constant(argument, labels, label_base=instruction_number + 1, address=instruction_number)
     except InvalidInstructionParsed as e:
         raise InvalidInstructionParsed(
             f"{str(e)}\nMaybe you misspelled a label?")
@@ -200,368 +536,1922 @@ def m_format(opcode: int) -> int:
     return (opcode << 27) | 0
 
 
-def parse_line(line: str, labels: dict[str, int], instruction_number: int) -> int:
-
-    instruction_match = re.match(r"^\s*(?P<instruction>\w+)", line)
-    if (instruction_match is None):
-        raise InvalidInstructionParsed("couldn't get instruction name")
+# encoders take the operand fields matched by the instruction's grammar and
+# return the encoded 32 bit word
+def encode_reg_reg_reg(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    ra = get_register_number(operands['ra'])
+    rb = get_register_number(operands['rb'])
+    rc = get_register_number(operands['rc'])
+    return r_format(opcode, ra, rb, rc)
+
+
+def encode_reg_reg_const(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    ra = get_register_number(operands['ra'])
+    rb = get_register_number(operands['rb'])
+    const = get_constant(operands['const'], labels, address=instruction_number)
+    return i_format(opcode, ra, rb, const)
+
+
+def encode_reg_const(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    ra = get_register_number(operands['ra'])
+    c2 = get_c2_for_branch(instruction_name)
+    # const can also be a label
+    const = get_branch_offset(operands['const'], labels, instruction_number)
+    return b_format(opcode, ra, c2, const)
+
+
+def encode_reg(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    ra = get_register_number(operands['ra'])
+    return j_format(opcode, ra)
+
+
+def encode_reg_reg(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    ra = get_register_number(operands['ra'])
+    rb = get_register_number(operands['rb'])
+    return i_format(opcode, ra, rb)
+
+
+# hi(x) and lo(x) look like an offset from register x, so they are only taken
+# as the functions when x isn't a register. a label named hi or lo still works
+# as an offset: ld r1, lo(r2)
+offset_function_regex = re.compile(rf"\b(?:{'|'.join(expression_functions)})$")
+
+
+def encode_offset_reg(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    ra = get_register_number(operands['ra'])
+    # rb is left out for the r0 case
+    rb_name = operands.get('rb') or "r0"
+    const_string = operands['const'].strip()
+    if register_names.get().get(rb_name.lower()) is None and offset_function_regex.search(const_string):
+        const_string = f"{const_string}({rb_name})"
+        rb_name = "r0"
+    rb = get_register_number(rb_name)
+    const = get_constant(const_string, labels, address=instruction_number)
+    return i_format(opcode, ra, rb, const)
+
+
+def encode_no_args(instruction_name: str, opcode: int, operands: dict[str, str], labels: dict[str, int], instruction_number: int) -> int:
+    return m_format(opcode)
+
+
+Encoder = Callable[[str, int, dict[str, str], dict[str, int], int], int]
+
+
+class InstructionEncoding(NamedTuple):
+    opcode: int
+    description: str
+    # operand patterns, tried in order against the text after the mnemonic
+    grammar: tuple[re.Pattern[str], ...]
+    encoder: Encoder
+
+
+# the text of a constant expression (see parse_expression). before a
+# (register) it doesn't end in a space or with hi or lo, so lo(table) is a
+# constant, and operands without a ( are skipped straight away
+expression_pattern = r"[\w \-+*/<>&|().]+"
+offset_expression_pattern = r"(?=.*\()[\w \-+*/<>&|().]+(?<!\s)"
+
+# (instruction names, description used in errors, operand grammar, encoder)
+instruction_formats: list[tuple[list[str], str, tuple[str, ...], Encoder]] = [
+    (reg_reg_reg, "reg reg reg",
+     (r"(?P<ra>\w+)\s*,\s*(?P<rb>\w+)\s*,\s*(?P<rc>\w+)",),
+     encode_reg_reg_reg),
+    (reg_reg_const, "reg reg const",
+     (rf"(?P<ra>\w+)\s*,\s*(?P<rb>\w+)\s*,\s*(?P<const>{expression_pattern})",),
+     encode_reg_reg_const),
+    (reg_const, "reg label",
+     (rf"(?P<ra>\w+)\s*,\s*(?P<const>{expression_pattern})",),
+     encode_reg_const),
+    (reg, "reg",
+     (r"(?P<ra>\w+)",),
+     encode_reg),
+    (reg_reg, "reg reg",
+     (r"(?P<ra>\w+)\s*,\s*(?P<rb>\w+)",),
+     encode_reg_reg),
+    (reg_offset_reg, "reg offset reg",
+     (rf"(?P<ra>\w+)\s*,\s*(?P<const>{offset_expression_pattern})\s*\(\s*(?P<rb>\w+)\s*\)",
+      rf"(?P<ra>\w+)\s*,\s*(?P<const>{expression_pattern})"),
+     encode_offset_reg),
+    (offset_reg_reg, "offset reg reg",
+     (rf"(?P<const>{offset_expression_pattern})\s*\(\s*(?P<rb>\w+)\s*\)\s*,\s*(?P<ra>\w+)",
+      rf"(?P<const>{expression_pattern})\s*,\s*(?P<ra>\w+)"),
+     encode_offset_reg),
+    (no_args, "no argument",
+     (r".*",),
+     encode_no_args),
+]
+
+
+def build_instruction_table() -> dict[str, InstructionEncoding]:
+    table: dict[str, InstructionEncoding] = {}
+    for names, description, grammar, encoder in instruction_formats:
+        compiled_grammar = tuple(re.compile(pattern) for pattern in grammar)
+        for name in names:
+            opcode = opcodes[name]
+            validate_opcode(opcode)
+            table[name] = InstructionEncoding(
+                opcode, description, compiled_grammar, encoder)
+    return table
+
+
+instruction_table = build_instruction_table()
+
+# splits a statement into its mnemonic and the text of its operands
+statement_regex = re.compile(r"^\s*(?P<instruction>\.?\w+)\s*(?P<operands>.*?)\s*$")
+# splits a source line into its labels, statement and comment, with the
+# statement also split into its mnemonic and operands
+source_line_regex = re.compile(
+    r"^(?P<labels>(?:\s*\w+:)*)\s*(?P<statement>(?P<instruction>\.?\w*)(?:\s*(?P<operands>[^;\s](?:[^;]*[^;\s])?))?)\s*(?:;(?P<comment>.*))?$")
+label_regex = re.compile(r"(\w+):")
+directive_operand_regexes = {
+    "org": re.compile(expression_pattern),
+    "word": re.compile(expression_pattern),
+    "fill": re.compile(rf"{expression_pattern},{expression_pattern}"),
+    "space": re.compile(expression_pattern),
+    "words": re.compile(rf"{expression_pattern}(?:,{expression_pattern})*"),
+    "incbin": re.compile(r'"[^"]+"'),
+}
+# directives that put a block of words in memory, encoded as one array
+data_directives = {"fill", "space", "words", "incbin"}
 
-    instruction_name = instruction_match.groupdict()['instruction']
 
-    if instruction_name not in opcodes:
+def encode_statement(line: str, instruction_name: str, operand_string: str, labels: dict[str, int], instruction_number: int) -> int:
+    encoding = instruction_table.get(instruction_name)
+    if encoding is None:
         raise InvalidInstructionParsed(
             f"unknown instruction name: {instruction_name}")
 
-    opcode = opcodes[instruction_name]
-    validate_opcode(opcode)
+    for pattern in encoding.grammar:
+        if operand_match := pattern.fullmatch(operand_string):
+            return encoding.encoder(instruction_name, encoding.opcode, operand_match.groupdict(), labels, instruction_number)
 
-    if instruction_name in reg_reg_reg:
-        match = re.match(
-            r"^\s*\w+\s+(?P<ra>\w+)\s*,\s*(?P<rb>\w+)\s*,\s*(?P<rc>\w+)\s*$", line)
-        if match is None:
-            raise InvalidInstructionParsed(
-                f"failed to parse reg reg reg instruction: {line}")
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        rb = get_register_number(match_dict['rb'])
-        rc = get_register_number(match_dict['rc'])
-        return r_format(opcode, ra, rb, rc)
-
-    elif instruction_name in reg_reg_const:
-        match = re.match(
-            r"^\s*\w+\s+(?P<ra>\w+)\s*,\s*(?P<rb>\w+)\s*,\s*(?P<const>[\w \-]+)\s*$", line)
-        if match is None:
-            raise InvalidInstructionParsed(
-                f"failed to parse reg reg const instruction: {line}")
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        rb = get_register_number(match_dict['rb'])
-        const = get_constant(match_dict['const'], labels)
-        return i_format(opcode, ra, rb, const)
-
-    elif instruction_name in reg_const:
-        #                                                 const can also be a label
-        match = re.match(
-            r"^\s*\w+\s+(?P<ra>\w+)\s*,\s*(?P<const>[\w \-]+)\s*$", line)
-        if match is None:
-            raise InvalidInstructionParsed(
-                f"failed to parse reg label instruction: {line}")
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        c2 = get_c2_for_branch(instruction_name)  # could be error?
-        const = get_branch_offset(
-            # could be a label
-            match_dict['const'], labels, instruction_number)
-        return b_format(opcode, ra, c2, const)
-
-    elif instruction_name in reg:
-        match = re.match(r"^\s*\w+\s+(?P<ra>\w+)\s*$", line)
-        if match is None:
-            raise InvalidInstructionParsed(
-                f"failed to parse reg instruction: {line}")
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        return j_format(opcode, ra)
-
-    elif instruction_name in reg_reg:
-        match = re.match(r"^\s*\w+\s+(?P<ra>\w+)\s*,\s*(?P<rb>\w+)\s*$", line)
-        if match is None:
-            raise InvalidInstructionParsed(
-                f"failed to parse reg reg instruction: {line}")
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        rb = get_register_number(match_dict['rb'])
-        return i_format(opcode, ra, rb)
-
-    elif instruction_name in reg_offset_reg:
-        # also handle the r0 case
-        match = re.match(
-            r"^\s*\w+\s+(?P<ra>\w+)\s*,\s*(?P<const>[\w \-]+)\s*\(\s*(?P<rb>\w+)\s*\)\s*$", line)
-        if match is None:
-            # try matching without it
-            match = re.match(
-                r"^\s*\w+\s+(?P<ra>\w+)\s*,\s*(?P<const>[\w \-]+)\s*$", line)
-            if match is None:
-                raise InvalidInstructionParsed(
-                    f"failed to parse reg offset reg instruction: {line}")
-
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        rb = get_register_number(match_dict.get('rb', "r0"))
-        const = get_constant(match_dict['const'], labels)
-        return i_format(opcode, ra, rb, const)
-
-    elif instruction_name in offset_reg_reg:
-        # also handle the r0 case
-        match = re.match(
-            r"^\s*\w+\s+(?P<const>[\w \-]+)\s*\(\s*(?P<rb>\w+)\s*\)\s*,\s*(?P<ra>\w+)\s*$", line)
-        if match is None:
-            # try matching without it
-            match = re.match(
-                r"^\s*\w+\s+(?P<const>[\w \-]+)\s*,\s*(?P<ra>\w+)\s*$", line)
-            if match is None:
-                raise InvalidInstructionParsed(
-                    f"failed to parse offset reg reg instruction: {line}")
+    raise InvalidInstructionParsed(
+        f"failed to parse {encoding.description} instruction: {line}")
 
-        match_dict = match.groupdict()
-        ra = get_register_number(match_dict['ra'])
-        rb = get_register_number(match_dict.get('rb', "r0"))
-        const = get_constant(match_dict['const'], labels)
-        return i_format(opcode, ra, rb, const)
 
-    elif instruction_name in no_args:
-        return m_format(opcode)
+def parse_line(line: str, labels: dict[str, int], instruction_number: int) -> int:
 
-    else:
-        raise InvalidInstructionParsed("instruction name is not valid")
+    statement_match = statement_regex.match(line)
+    if (statement_match is None):
+        raise InvalidInstructionParsed("couldn't get instruction name")
+
+    instruction_name, operand_string = statement_match.groups()
+    return encode_statement(line, instruction_name, operand_string, labels, instruction_number)
+
+
+# returns the directive name (org, word or a data directive) if the statement
+# is a directive. they can also be written with a leading dot (.org)
+def get_directive(instruction_name: str, operand_string: str) -> str | None:
+    directive = instruction_name.lower().removeprefix(".")
+    operand_regex = directive_operand_regexes.get(directive)
+    if operand_regex is None or not operand_regex.fullmatch(operand_string):
+        return None
+    return directive
 
 
 def extract_labels_and_instruction(line: str) -> tuple[list[str], str]:
-    labels: list[str] = []
-    while (True):
-        line_match = re.match(r"^\s*(?P<label>\w+):(?P<rest>.*)", line)
-        if (line_match is None):
-            break
+    line_match = source_line_regex.match(line)
+    assert line_match is not None  # every line matches
+    return label_regex.findall(line_match['labels']), line_match['statement']
+
+
+def split_source_line(line_with_comment: str) -> tuple[str, str, str, str, str]:
+    line_match = source_line_regex.match(line_with_comment)
+    assert line_match is not None  # every line matches
+    return line_match.groups("")
+
+
+def get_org_address(org_const: str, labels: dict[str, int], depth: int, address: int) -> int:
+    org_value = get_constant(org_const, labels, address=address)
+    if (org_value > depth - 1):
+        raise InvalidInstructionParsed(f"org value {org_const} (decimal {
+                                       org_value}) is above the maximum of {depth - 1}")
+    if (org_value < 0):
+        raise InvalidInstructionParsed(
+            f"org value {org_const} (decimal {org_value}) must be above 0")
+    return org_value
+
+
+# incbin reads files relative to this directory. it is None when there are no
+# files to read, like on the website
+include_directory: ContextVar[str | None] = ContextVar(
+    "include_directory", default=None)
+
+
+@contextmanager
+def include_files_from(directory: str) -> Iterator[None]:
+    token = include_directory.set(directory)
+    try:
+        yield
+    finally:
+        include_directory.reset(token)
 
-        labels.append(line_match.groupdict()["label"])
-        line = line_match.groupdict()["rest"]
 
-    return labels, line.strip()
+# include looks for files next to the source (see include_directory) and then
+# in the library, which is set by Assembler for a server
+library_directory: ContextVar[str | None] = ContextVar(
+    "library_directory", default=None)
 
 
-def first_pass(code_string: str) -> tuple[dict[str, int], list[tuple[int, str]], list[tuple[int, str]]]:
+@contextmanager
+def include_library_from(directory: str | None) -> Iterator[None]:
+    token = library_directory.set(directory)
+    try:
+        yield
+    finally:
+        library_directory.reset(token)
+
+
+def get_binary_path(operand_string: str) -> str:
+    directory = include_directory.get()
+    if directory is None:
+        raise InvalidInstructionParsed(
+            "incbin can only be used when assembling files")
+    return os.path.join(directory, operand_string[1:-1])
 
-    code_lines_with_comments = code_string.splitlines()
 
+def get_data_count(count_string: str, labels: dict[str, int], address: int) -> int:
+    count = get_constant(count_string.strip(), labels, bit_width=32, address=address)
+    if count < 1:
+        raise InvalidInstructionParsed(
+            f"count {count_string.strip()} (decimal {count}) must be at least 1")
+    return count
+
+
+# words put in memory by a data directive, known in the first pass since
+# counts can't use later labels. checked against the memory left so a typo
+# doesn't build a huge array
+def get_data_size(directive: str, operand_string: str, labels: dict[str, int], instruction_number: int, depth: int) -> int:
+    if directive == "words":
+        size = operand_string.count(",") + 1
+    elif directive == "incbin":
+        path = get_binary_path(operand_string)
+        try:
+            size = (os.path.getsize(path) + 3) // 4
+        except OSError as e:
+            raise InvalidInstructionParsed(f"can't read {path}: {e.strerror}")
+        if size == 0:
+            raise InvalidInstructionParsed(f"{path} is empty")
+    else:  # fill and space
+        size = get_data_count(operand_string.split(",", 1)[0], labels, instruction_number)
+
+    if instruction_number + size > depth:
+        raise InvalidInstructionParsed(
+            f"{directive} of {size} words at address {instruction_number:X} goes past the end of memory ({depth} words)")
+    return size
+
+
+# matched against the list joined back together without spaces
+decimal_data_regex = re.compile(r"-?[0-9]+(?:,-?[0-9]+)*")
+hex_data_regex = re.compile(r"0x[0-9a-f]+(?:,0x[0-9a-f]+)*")
+
+
+# a list of only decimal or only hex values (the usual tables) is converted,
+# range checked and packed by array in one go, anything else is converted a
+# constant at a time by get_constant, which also gives the errors
+def get_data_words(operand_string: str, labels: dict[str, int], address: int) -> array:
+    values = [value.strip() for value in operand_string.split(",")]
+    compact_string = ",".join(values)
+    if isinstance(labels, dict) and labels.keys().isdisjoint(values):
+        try:
+            if decimal_data_regex.fullmatch(compact_string):
+                # signed 32 bit like get_constant, stored as the same bits
+                words = array(WORD_TYPECODE)
+                words.frombytes(array("i", map(int, values)).tobytes())
+                return words
+            if hex_data_regex.fullmatch(compact_string.lower()):
+                words = array(WORD_TYPECODE, map(int, values, repeat(16)))
+                if max(words) > 0x7FFFFFFF:
+                    for value, word in zip(values, words):
+                        if word > 0x7FFFFFFF:
+                            warn(f"unsigned constant value {value.lower()} will be treated as negative by CPU")
+                return words
+        except OverflowError:
+            pass
+
+    return array(WORD_TYPECODE, [get_constant(value, labels, bit_width=32, address=address) & 0xFFFFFFFF
+                                 for value in values])
+
+
+# . is the address of the directive's first word
+def encode_data(directive: str, operand_string: str, labels: dict[str, int], address: int) -> array:
+    if directive == "words":
+        return get_data_words(operand_string, labels, address)
+
+    if directive == "incbin":
+        path = get_binary_path(operand_string)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            raise InvalidInstructionParsed(f"can't read {path}: {e.strerror}")
+        # whole words, most significant byte first like bin output
+        words = array(WORD_TYPECODE, data + bytes(-len(data) % 4))
+        if sys.byteorder == "little":
+            words.byteswap()
+        return words
+
+    if directive == "space":
+        return array(WORD_TYPECODE, bytes(4 * get_data_count(operand_string, labels, address)))
+
+    count_string, value_string = operand_string.split(",", 1)
+    value = get_constant(value_string.strip(), labels, bit_width=32, address=address)
+    return array(WORD_TYPECODE, [value & 0xFFFFFFFF]) * get_data_count(count_string, labels, address)
+
+
+# the lines of a program given as one string, or as any iterable of lines such
+# as an open file, which is then read as it goes instead of all at once. both
+# are split like str.splitlines
+def source_lines(code: str | Iterable[str]) -> Iterable[str]:
+    if isinstance(code, str):
+        return code.splitlines()
+    return (line for chunk in code for line in chunk.splitlines() or [""])
+
+
+# the statements of a program with their place in memory, as
+# (line number, line, statement, mnemonic, operands, address, words)
+Statement = tuple[int, str, str, str, str, int, int]
+
+
+class Layout:
+    """Places the lines of a program in memory, with their labels, org directives, comments and data sizes"""
+
+    def __init__(self, labels: dict[str, int], depth: int):
+        self.labels = labels
+        self.depth = depth
+        self.address = 0
+        self.comments: list[tuple[int, str]] = []
+        # org and counts can't use later labels, so they see the labels
+        # defined so far as a plain mapping even when labels is ForwardLabels
+        self._defined_labels = MappingProxyType(labels)
+
+    # split_line can be swapped for a memoized version when the same lines are
+    # assembled repeatedly (see IncrementalAssembler). line numbers count from 1
+    def statements(self, code_string: str | Iterable[str], split_line: Callable[[str], tuple[str, str, str, str, str]] = split_source_line) -> Iterator[Statement]:
+        labels = self.labels
+        comments = self.comments
+        address = self.address
+        for line_number, line in enumerate(source_lines(code_string), 1):
+            line_labels_string, instruction, instruction_name, operand_string, comment = split_line(line)
+
+            directive = get_directive(instruction_name, operand_string) if instruction else None
+            data_size: int | None = 1
+            if directive == "org":
+                org_address = self.evaluate(
+                    line_number, line, get_org_address, operand_string, self._defined_labels, self.depth, address)
+                if org_address is not None:
+                    address = org_address
+            elif directive in data_directives:
+                data_size = self.evaluate(
+                    line_number, line, get_data_size, directive, operand_string, self._defined_labels, address, self.depth)
+
+            # add comment after org directive changes the address
+            if comment:
+                comments.append((address, comment))
+
+            if line_labels_string:
+                for index, label in enumerate(label_regex.findall(line_labels_string)):
+                    if label in labels:
+                        self.duplicate_label(line_number, line, label, index)
+                    else:
+                        labels[label] = address
+
+            # directives other than org take memory like instructions, a data
+            # directive whose size is wrong (when checking) is left out
+            if instruction and directive != "org" and data_size is not None:
+                yield line_number, line, instruction, instruction_name, operand_string, address, data_size
+                address += data_size
+        self.address = address
+
+    # works out an org address or data size, check reports the error instead
+    # of raising and gets None back
+    def evaluate(self, line_number: int, line: str, function: Callable, *arguments):
+        return function(*arguments)
+
+    def duplicate_label(self, line_number: int, line: str, label: str, index: int):
+        raise InvalidInstructionParsed(f"Duplicate labels with name: {label}")
+
+
+def first_pass(code_string: str | Iterable[str], split_line: Callable[[str], tuple[str, str, str, str, str]] = split_source_line, depth: int = DEFAULT_MEMORY_DEPTH) -> tuple[dict[str, int], list[tuple[int, str]], list[tuple[int, str]], list[int]]:
     labels: dict[str, int] = {}
     instruction_list: list[tuple[int, str]] = []
-    comments: list[tuple[int, str]] = []
-
-    instruction_number = 0
-    for line_with_comment in code_lines_with_comments:
-        line_match = re.match(
-            r"(?P<line_no_comment>.*?);(?P<comment>.*)", line_with_comment)
-        line: str
-        comment: str = ""
-        if line_match is not None:
-            line = line_match.groupdict()["line_no_comment"]
-            comment = line_match.groupdict()["comment"]
-        else:
-            line = line_with_comment
+    line_numbers: list[int] = []
 
-        line_labels, instruction = extract_labels_and_instruction(line)
+    layout = Layout(labels, depth)
+    for line_number, _, instruction, _, _, instruction_number, data_size in layout.statements(code_string, split_line):
+        instruction_list.append((instruction_number, instruction))
+        line_numbers.append(line_number)
+        if data_size > 1:
+            add_data_entries(instruction_list, line_numbers,
+                             instruction_number, data_size, line_number)
 
-        line_has_instruction = True  # directives don't count as instructions
+    return labels, instruction_list, layout.comments, line_numbers
 
-        if instruction == "":
-            line_has_instruction = False
 
-        # check for assembler directives that do special behavior
-        # check for org first
-        if match := re.match(r"^\s*org\s+(?P<const>[\w \-]+)\s*$", instruction.lower()):
-            line_has_instruction = False
-            org_value = get_constant(match.groupdict()['const'], labels)
-            if (org_value > 511):
-                raise InvalidInstructionParsed(f"org value {match.groupdict()['const']} (decimal {
-                                               org_value}) is above the maximum of 511")
-            if (org_value < 0):
-                raise InvalidInstructionParsed(
-                    f"org value {match.groupdict()['const']} (decimal {org_value}) must be above 0")
+# the instructions have an entry for every word, the words after the first
+# one of a data directive get an empty statement
+def add_data_entries(instruction_list: list[tuple[int, str]], line_numbers: list[int], instruction_number: int, data_size: int, line_number: int):
+    instruction_list.extend(zip(range(instruction_number + 1, instruction_number + data_size), repeat("")))
+    line_numbers.extend(repeat(line_number, data_size - 1))
 
-            instruction_number = org_value
 
-        # add comment after org directive changes inst number
-        if comment != "":
-            comments.append((instruction_number, comment))
+# data directives encode to an array of words, the first of them at address
+def add_encoded_words(encoded_instructions: list[tuple[int, int]], memory_address: int, word: int | array):
+    if isinstance(word, array):
+        encoded_instructions.extend(
+            zip(range(memory_address, memory_address + len(word)), word))
+    else:
+        encoded_instructions.append((memory_address, word))
 
-        for label in line_labels:
-            if label not in labels:
-                labels[label] = instruction_number
-            else:
-                raise InvalidInstructionParsed(
-                    f"Duplicate labels with name: {label}")
 
-        if not line_has_instruction:
-            continue
+# data directives encode to an array of words, everything else to one word
+def encode_instruction(instruction: str, labels: dict[str, int], memory_address: int) -> int | array:
+    statement_match = statement_regex.match(instruction)
+    if (statement_match is None):
+        raise InvalidInstructionParsed("couldn't get instruction name")
+    instruction_name, operand_string = statement_match.groups()
+    return encode_split_instruction(instruction, instruction_name, operand_string, labels, memory_address)
 
-        instruction_list.append((instruction_number, instruction))
-        instruction_number += 1
 
-    return labels, instruction_list, comments
+def encode_split_instruction(instruction: str, instruction_name: str, operand_string: str, labels: dict[str, int], memory_address: int) -> int | array:
+    # assembler directives to change memory data
+    directive = get_directive(instruction_name, operand_string)
+    if directive == "word":
+        # a negative value is stored as its two's complement, like in words
+        return get_constant(
+            operand_string,
+            labels,
+            bit_width=32,
+            address=memory_address,
+        ) & 0xFFFFFFFF
+    if directive in data_directives:
+        return encode_data(directive, operand_string, labels, memory_address)
+
+    return encode_statement(instruction, instruction_name, operand_string, labels, memory_address)
 
 
 def second_pass(labels: dict[str, int], instructions: list[tuple[int, str]]) -> list[tuple[int, int]]:
-    memory_entries: list[tuple[int, int]] = []
+    encoded_instructions: list[tuple[int, int]] = []
     for memory_address, instruction in instructions:
+        if not instruction:
+            continue  # the rest of a data directive, added with its first word
+        add_encoded_words(encoded_instructions, memory_address,
+                          encode_instruction(instruction, labels, memory_address))
+    return encoded_instructions
 
-        # assembler directives to change memory data
-        if match := re.match(r"^\s*word\s+(?P<const>\w+)\s*$", instruction.lower()):
-            constant = get_constant(
-                match.groupdict()['const'],
-                labels,
-                bit_width=32,
-            )
-            memory_entries.append((memory_address, constant))
-            continue
 
-        memory_entries.append(
-            (memory_address, parse_line(instruction, labels, memory_address)))
+Assembly = tuple[dict[str, int], list[tuple[int, str]],
+                 list[tuple[int, str]], list[tuple[int, int]]]
 
-    return memory_entries
 
+class Fixup(NamedTuple):
+    index: int  # of the instruction in the assembly
+    label: str | None  # None when the whole instruction is encoded again
+    label_base: int
+    bit_width: int
 
-def assemble(code: str) -> tuple[dict[str, int], list[tuple[int, str]], list[tuple[int, str]], list[tuple[int, int]]]:
-    labels, instructions, comments = first_pass(code)
-    return labels, instructions, comments, second_pass(labels, instructions)
 
+# runs the function, holding back the warnings it gives with the index of the
+# instruction they belong to
+def hold_warnings(held_warnings: list[tuple[int, str]], index: int, function: Callable, *arguments):
+    warnings: list[str] = []
+    token = collected_warnings.set(warnings)
+    try:
+        return function(*arguments)
+    finally:
+        collected_warnings.reset(token)
+        held_warnings.extend((index, warning) for warning in warnings)
 
-def assembly_to_file(file_extension: str, file_string: str):
-    labels, instructions, comments, encoded_instructions = assemble(
-        file_string)
 
-    comment_dict: dict[int, list[str]] = {}
-    for address, comment in comments:
-        if address in comment_dict:
-            comment_dict[address].append(comment)
-        else:
-            comment_dict[address] = [comment]
+# parses and encodes every line once. a label used before it is defined is
+# encoded as 0 and gets a fixup to patch in its value once every label is
+# known, an instruction that fails to encode gets one to encode it again.
+# encoding warnings are held back until then, like they were with two passes
+def single_pass(code_string: str | Iterable[str], split_line: Callable[[str], tuple[str, str, str, str, str]] = split_source_line, depth: int = DEFAULT_MEMORY_DEPTH) -> tuple[Assembly, list[int], list[Fixup], list[tuple[int, str]]]:
+
+    labels = ForwardLabels()
+    instruction_list: list[tuple[int, str]] = []
+    encoded_instructions: list[tuple[int, int]] = []
+    line_numbers: list[int] = []
+    fixups: list[Fixup] = []
+    held_warnings: list[tuple[int, str]] = []
+
+    layout = Layout(labels, depth)
+    try:
+        with collect_warnings() as warnings:
+            for line_number, _, instruction, instruction_name, operand_string, instruction_number, data_size in layout.statements(code_string, split_line):
+                index = len(encoded_instructions)
+                instruction_list.append((instruction_number, instruction))
+                line_numbers.append(line_number)
+                reported_warnings = len(warnings)
+                try:
+                    if not instruction_name:
+                        raise InvalidInstructionParsed(
+                            "couldn't get instruction name")
+                    word = encode_split_instruction(
+                        instruction, instruction_name, operand_string, labels, instruction_number)
+                except InvalidInstructionParsed:
+                    # errors are raised by apply_fixups so labels and org problems
+                    # further down are still reported first, like with two passes
+                    fixups.append(Fixup(index, None, 0, 0))
+                    labels.forward_references.clear()
+                    word = 0
+                    del warnings[reported_warnings:]  # given again by the fixup
+                if labels.forward_references:
+                    if data_size > 1:
+                        # a word list is encoded again as a whole
+                        fixups.append(Fixup(index, None, 0, 0))
+                    else:
+                        fixups.extend(Fixup(index, *reference)
+                                      for reference in labels.forward_references)
+                    labels.forward_references.clear()
+                if len(warnings) > reported_warnings:
+                    held_warnings.extend((index, warning)
+                                         for warning in warnings[reported_warnings:])
+                    del warnings[reported_warnings:]
+                if data_size > 1:
+                    add_data_entries(instruction_list, line_numbers,
+                                     instruction_number, data_size, line_number)
+                    words = word if isinstance(word, array) else repeat(0)
+                    encoded_instructions.extend(
+                        zip(range(instruction_number, instruction_number + data_size), words))
+                else:
+                    encoded_instructions.append((instruction_number, word[0] if isinstance(word, array) else word))
+    finally:
+        # what's left came from org values, which aren't held back
+        for warning in warnings:
+            warn(warning)
+
+    # a label named like a number (10:, 0x1F:) changes what an earlier use of
+    # that number meant, so every instruction is encoded again
+    if any(constant_regex.match(label.lower()) for label in labels):
+        fixups = [Fixup(index, None, 0, 0)
+                  for index, (_, instruction) in enumerate(instruction_list) if instruction]
+        held_warnings = []
+    return (dict(labels), instruction_list, layout.comments, encoded_instructions), line_numbers, fixups, held_warnings
+
+
+# patches the label values into the fixups, then shows the held warnings in
+# source order (only those before the first error if there is one)
+def apply_fixups(assembly: Assembly, fixups: list[Fixup], held_warnings: list[tuple[int, str]]) -> list[tuple[int, int]]:
+    labels, instructions, _, encoded_instructions = assembly
+    error_index = len(instructions)
+    try:
+        for index, label, label_base, bit_width in fixups:
+            memory_address, word = encoded_instructions[index]
+            value = labels.get(label) if label is not None else None
+            if value is not None:
+                word |= (value - label_base) & ((1 << bit_width) - 1)
+            else:
+                # raises the error, like a misspelled label
+                word = hold_warnings(held_warnings, index, encode_instruction,
+                                     instructions[index][1], labels, memory_address)
+                if isinstance(word, array):
+                    encoded_instructions[index:index + len(word)] = zip(
+                        range(memory_address, memory_address + len(word)), word)
+                    continue
+            encoded_instructions[index] = (memory_address, word)
+    except Exception:
+        error_index = index
+        raise
+    finally:
+        for index, warning in sorted(held_warnings, key=lambda held: held[0]):
+            if index < error_index:
+                warn(warning)
+    return encoded_instructions
+
+
+# when set, called with the name of each phase (first_pass, second_pass,
+# build_memory and format) and how long it took in seconds
+phase_timer: Callable[[str, float], None] | None = None
+
+
+def set_phase_timer(timer: Callable[[str, float], None] | None):
+    global phase_timer
+    phase_timer = timer
+
+
+def timed_phase(phase: str, function: Callable, *arguments):
+    if phase_timer is None:
+        return function(*arguments)
+    start = time.perf_counter()
+    try:
+        return function(*arguments)
+    finally:
+        phase_timer(phase, time.perf_counter() - start)
+
+
+# the single pass is timed as first_pass and the fixups as second_pass
+# also returns the line number of every instruction
+def assemble_with_lines(code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH) -> tuple[Assembly, list[int]]:
+    lines, split_line, preprocessor = preprocess(code)
+    assembly, line_numbers, fixups, held_warnings = timed_phase(
+        "first_pass", single_pass, lines, split_line, depth)
+    timed_phase("second_pass", apply_fixups, assembly, fixups, held_warnings)
+    if preprocessor is not None:
+        line_numbers = preprocessor.source_line_numbers(line_numbers)
+    return assembly, line_numbers
+
+
+def assemble(code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH) -> Assembly:
+    return assemble_with_lines(code, depth)[0]
+
+
+class Diagnostic(NamedTuple):
+    severity: str  # error or warning
+    message: str
+    line: int  # lines and columns count from 1
+    column: int
+    end_column: int  # one past the last column
+
+
+# runs the function, reporting its error and the warnings it added at the span
+# of the line. returns the function's result, or None after an error
+def run_with_diagnostics(diagnostics: list[Diagnostic], warnings: list[str], line_number: int, span: tuple[int, int], function: Callable, *arguments):
+    reported_warnings = len(warnings)
+    try:
+        result = function(*arguments)
+    except Exception as e:
+        diagnostics.append(Diagnostic(
+            "error", str(e), line_number, span[0] + 1, span[1] + 1))
+        result = None
+    if len(warnings) > reported_warnings:
+        for warning in warnings[reported_warnings:]:
+            diagnostics.append(Diagnostic(
+                "warning", warning, line_number, span[0] + 1, span[1] + 1))
+    return result
+
+
+# goes through the program like first_pass and second_pass, but keeps going
+# after errors so every problem is reported at once. no output is formatted
+def check(code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH) -> list[Diagnostic]:
+    with collect_warnings() as warnings:
+        return check_lines(code, depth, warnings)
+
+
+class CheckedLayout(Layout):
+    """Layout that reports problems as diagnostics at their place in the line and keeps going"""
+
+    def __init__(self, labels: dict[str, int], depth: int, diagnostics: list[Diagnostic], warnings: list[str]):
+        super().__init__(labels, depth)
+        self.diagnostics = diagnostics
+        self.warnings = warnings
+
+    def evaluate(self, line_number: int, line: str, function: Callable, *arguments):
+        return run_with_diagnostics(self.diagnostics, self.warnings, line_number, get_line_span(line, "operands"),
+                                    function, *arguments)
 
-    instruction_dict: dict[int, str] = {}
-    for address, instruction in instructions:
-        instruction_dict[address] = instruction
+    def duplicate_label(self, line_number: int, line: str, label: str, index: int):
+        labels_end = get_line_span(line, "labels")[1]
+        label_match = list(label_regex.finditer(line, 0, labels_end))[index]
+        self.diagnostics.append(Diagnostic(
+            "error", f"Duplicate labels with name: {label}", line_number,
+            label_match.start(1) + 1, label_match.end(1) + 1))
 
-    label_dict: dict[int, list[str]] = {}
-    for label, address in labels.items():
-        if address in label_dict:
-            label_dict[address].append(label)
+
+def get_line_span(line: str, part: str) -> tuple[int, int]:
+    line_match = source_line_regex.match(line)
+    assert line_match is not None  # every line matches
+    return line_match.span(part)
+
+
+# the lines are numbered as the passes see them, after preprocessing, and
+# moved to their source lines at the end
+def check_lines(code: str | Iterable[str], depth: int, warnings: list[str]) -> list[Diagnostic]:
+    diagnostics: list[Diagnostic] = []
+    labels: dict[str, int] = {}
+
+    lines, split_line, preprocessor = preprocess(code, keep_going=True)
+    layout = CheckedLayout(labels, depth, diagnostics, warnings)
+    # (line number, statement span, address, statement, words)
+    statements = [(line_number, get_line_span(line, "statement"), address, instruction, data_size)
+                  for line_number, line, instruction, _, _, address, data_size in layout.statements(lines, split_line)]
+
+    used_lines: dict[int, int] = {}
+    for line_number, span, address, instruction, data_size in statements:
+        addresses = range(address, address + data_size)
+        if address >= depth:
+            diagnostics.append(Diagnostic(
+                "error", f"Program too long, address {address:X} is past the end of memory ({depth} words)",
+                line_number, span[0] + 1, span[1] + 1))
+        elif overwritten := sorted(used_lines.keys() & addresses):
+            used_line = used_lines[overwritten[0]]
+            if preprocessor is not None:
+                used_line = preprocessor.line_numbers[used_line - 1]
+            diagnostics.append(Diagnostic(
+                "error", f"Program overwrites itself (bad org statement), address {overwritten[0]:X} is also used on line {used_line}",
+                line_number, span[0] + 1, span[1] + 1))
         else:
-            label_dict[address] = [label]
+            used_lines.update(zip(addresses, repeat(line_number)))
+        run_with_diagnostics(diagnostics, warnings, line_number, span,
+                             encode_instruction, instruction, labels, address)
+
+    if preprocessor is not None:
+        diagnostics = preprocessor.diagnostics + [preprocessor.locate(diagnostic) for diagnostic in diagnostics]
+    diagnostics.sort(key=lambda diagnostic: (diagnostic.line, diagnostic.column))
+    return diagnostics
+
+
+def format_diagnostic(filename: str, diagnostic: Diagnostic) -> str:
+    message = diagnostic.message.replace("\n", " ")
+    return f"{filename}:{diagnostic.line}:{diagnostic.column}: {diagnostic.severity}: {message}"
+
+
+class LabelLookupRecorder:
+    """Label table wrapper that remembers which labels were looked up (and their values)"""
+
+    def __init__(self, labels: dict[str, int]):
+        self.labels = labels
+        self.lookups: dict[str, int | None] = {}
+
+    def __contains__(self, label: str) -> bool:
+        value = self.labels.get(label)
+        self.lookups[label] = value
+        return value is not None
+
+    def __getitem__(self, label: str) -> int:
+        value = self.labels[label]
+        self.lookups[label] = value
+        return value
+
+
+# include, macro and equ are expanded before the passes (see Preprocessor).
+# sources that don't use them skip it
+preprocessor_keyword_regex = re.compile(r"\b(?:include|macro|endm|equ)\b", re.IGNORECASE)
+include_operand_regex = re.compile(r'"(?P<name>[^"]+)"')
+macro_operand_regex = re.compile(r"(?P<name>\w+)(?:\s+(?P<parameters>\w+(?:\s*,\s*\w+)*))?")
+equ_operand_regex = re.compile(r"\.?equ\s+(?P<value>\S.*)", re.IGNORECASE)
+# equ values that are put in as they are, others are put in parentheses so
+# x equ table+4 works in x*2
+equ_simple_value_regex = re.compile(r"-?\s*\w+")
+# macros can expand other macros, this keeps a program from growing without end
+MAX_MACRO_EXPANSIONS = 65536
+# a few expansions of macros that expand others can still make a huge program,
+# so the lines given to the passes are limited too (see Assembler)
+MAX_EXPANDED_LINES = 1_000_000
+INCLUDE_CACHE_SIZE = 64
+
+max_program_lines: ContextVar[int] = ContextVar(
+    "max_program_lines", default=MAX_EXPANDED_LINES)
+
+
+@contextmanager
+def limit_program_lines(max_lines: int) -> Iterator[None]:
+    token = max_program_lines.set(max_lines)
+    try:
+        yield
+    finally:
+        max_program_lines.reset(token)
 
-    if max([instruction[0] for instruction in encoded_instructions]) >= 512:
-        raise Exception("Program too long")
 
-    memory: dict[int, int] = {}
-    for instruction_number, instruction in encoded_instructions:
-        if instruction_number in memory:
-            raise Exception("Program overwrites itself (bad org statement)")
-        memory[instruction_number] = instruction
+class IncludeUnit(NamedTuple):
+    """The lines of an include file, each split like split_source_line"""
+    lines: list[str]
+    splits: list[tuple[str, str, str, str, str]]
+    plain: list[bool]  # whether each line is free of include, macro, endm and equ
+
+
+# include files by the hash of their content, so a library shared by many
+# programs is split into lines and tokenized once per process
+include_cache: OrderedDict[str, IncludeUnit] = OrderedDict()
+include_cache_lock = threading.Lock()
+
+
+def load_include(path: str) -> IncludeUnit:
+    with open(path, "rb") as f:
+        data = f.read()
+    key = hashlib.sha256(data).hexdigest()
+    with include_cache_lock:
+        unit = include_cache.get(key)
+        if unit is not None:
+            include_cache.move_to_end(key)
+            return unit
+
+    lines = data.decode("utf8").splitlines()
+    splits = [split_source_line(line) for line in lines]
+    unit = IncludeUnit(lines, splits, [is_plain_line(split) for split in splits])
+    with include_cache_lock:
+        include_cache[key] = unit
+        if len(include_cache) > INCLUDE_CACHE_SIZE:
+            include_cache.popitem(last=False)
+    return unit
+
+
+# the file called name in directory, if there is one. like "../x.s" or a link
+# the name can't lead out of the directory
+def find_file_inside(directory: str, name: str) -> str | None:
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(directory, name))
+    if os.path.commonpath([directory, path]) == directory and os.path.isfile(path):
+        return path
+    return None
+
+
+# files next to the source are found first, then the library. a name can't
+# lead out of either, since a server lets programs read nothing else
+def get_include_path(name: str) -> str:
+    for directory in (include_directory.get(), library_directory.get()):
+        if directory is not None and (path := find_file_inside(directory, name)) is not None:
+            return path
+    raise InvalidInstructionParsed(f"include file {name} was not found")
+
+
+preprocessor_keywords = ["include", "macro", "endm"]
+
+
+def is_plain_line(split: tuple[str, str, str, str, str]) -> bool:
+    return split[2].lower().removeprefix(".") not in preprocessor_keywords and equ_operand_regex.fullmatch(split[3]) is None
+
+
+def join_source_line(labels: str, instruction_name: str, operand_string: str, comment: str) -> tuple[str, tuple[str, str, str, str, str]]:
+    instruction = f"{instruction_name} {operand_string}" if operand_string else instruction_name
+    line = f"{labels} {instruction}" if labels else instruction
+    if comment:
+        line += f" ;{comment}"
+    return line, (labels, instruction, instruction_name, operand_string, comment)
+
+
+class Origin(NamedTuple):
+    """Where a line given to the passes came from, when it isn't a line of the source as written"""
+    description: str | None  # like "mul.s line 4" or "macro push", None for a line with constants put in
+    column: int  # span of the statement on the source line, counted from 1
+    end_column: int
+
+
+class Macro(NamedTuple):
+    name: str
+    parameters: list[str]
+    # every line with its split, its labels, mnemonic and operands as
+    # str.format templates taking the values of the parameters and labels
+    # (lines that use neither have no templates) and where it was written,
+    # like "line 3" or "mul.s line 4"
+    body: list[tuple[str, tuple[str, str, str, str, str], tuple[str, str, str] | None, str]]
+    labels: list[str]  # defined in the body, renamed in every expansion
+
+
+# a part of a macro's line as a template, with its names as numbered fields
+def get_macro_template(part: str, names_regex: re.Pattern, indexes: dict[str, int]) -> str:
+    pieces = names_regex.split(part)
+    pieces[::2] = [piece.replace("{", "{{").replace("}", "}}") for piece in pieces[::2]]
+    pieces[1::2] = [f"{{{indexes[name]}}}" for name in pieces[1::2]]
+    return "".join(pieces)
+
+
+class Preprocessor:
+    """Expands include, macro and equ into the lines given to the passes, keeping the source line each came from"""
+
+    def __init__(self, split_line: Callable[[str], tuple[str, str, str, str, str]] = split_source_line, keep_going: bool = False):
+        self.split_line = split_line
+        # errors become diagnostics and their line is left out, for check
+        self.keep_going = keep_going
+        self.diagnostics: list[Diagnostic] = []
+        self.line_numbers = array("I")  # source line of every line given to the passes
+        self.origins: dict[int, Origin] = {}  # by line given to the passes, counted from 1
+        # the lines of include files share their include's origin, with their
+        # own line numbers here
+        self.origin_lines: dict[int, int] = {}
+        self.max_lines = max_program_lines.get()
+        self.macros: dict[str, Macro] = {}
+        self.constants: dict[str, str] = {}
+        self.labels: set[str] = set()  # of the lines given to the passes, which can't also be constants
+        self.included: set[str] = set()  # every file is only included once
+        self.expansions = 0
+        self._constants_regex: re.Pattern | None = None
+        self._expanding: list[str] = []
+        # name, parameters and where the macro being defined starts
+        self._definition: tuple[str, list[str], int, Origin | None, str] | None = None
+        self._body: list[tuple[str, tuple[str, str, str, str, str], str]] = []
+        self._line_number = 0
+        # the lines given to the passes, with their splits
+        self._batch: list[tuple[str, tuple[str, str, str, str, str]]] = []
+        self._passed: tuple[str, tuple[str, str, str, str, str]] = ("", ("", "", "", "", ""))
+        self._splits: dict[str, tuple[str, str, str, str, str]] = {}
+
+    # the whole source at once, as a string with the splits of its lines kept
+    # for split_expanded_line
+    def expand(self, code: str) -> str:
+        try:
+            for line_number, line in enumerate(code.splitlines(), 1):
+                self._line_number = line_number
+                self._process(line, self.split_line(line), None)
+            self._end()
+        except ProgramTooLarge as e:
+            self._stop(e, line)
+        self._splits = dict(self._batch)
+        return "\n".join([line for line, _ in self._batch])
+
+    def split_expanded_line(self, line: str) -> tuple[str, str, str, str, str]:
+        split = self._splits.get(line)
+        return self.split_line(line) if split is None else split
+
+    # a line at a time, each source line is expanded in full before its lines
+    # are handed out
+    def lines(self, code: str | Iterable[str]) -> Iterator[str]:
+        for line_number, line in enumerate(source_lines(code), 1):
+            self._line_number = line_number
+            try:
+                self._process(line, self.split_line(line), None)
+            except ProgramTooLarge as e:
+                self._stop(e, line)
+                return
+            batch = self._batch
+            if batch:
+                self._batch = []
+                for passed in batch:
+                    self._passed = passed
+                    yield passed[0]
+        self._end()
+
+    # the passes split every line right after they get it, so the split made
+    # here is handed back instead of being made again
+    def split_passed_line(self, line: str) -> tuple[str, str, str, str, str]:
+        passed_line, split = self._passed
+        return split if line == passed_line else self.split_line(line)
+
+    # a program that grew too large is reported once at the line that made it
+    # too large. none of that line's lines are given to the passes and nothing
+    # after it is expanded
+    def _stop(self, e: ProgramTooLarge, line: str):
+        if not self.keep_going:
+            raise e
+        # the batch ends with the lines of this line, line_numbers is sorted
+        dropped = len(self.line_numbers) - bisect.bisect_left(self.line_numbers, self._line_number)
+        del self._batch[len(self._batch) - dropped:]
+        del self.line_numbers[len(self.line_numbers) - dropped:]
+        self._error(str(e), None, line)
+
+    def _end(self):
+        if self._definition is not None:
+            name, _, self._line_number, origin, line = self._definition
+            self._error(f"macro {name} has no endm", origin, line)
+
+    def source_line_numbers(self, line_numbers: list[int]) -> list[int]:
+        source_line_numbers = self.line_numbers
+        return [source_line_numbers[line_number - 1] for line_number in line_numbers]
+
+    # moves a diagnostic of a line given to the passes to the source line it
+    # came from
+    def locate(self, diagnostic: Diagnostic) -> Diagnostic:
+        line_number = self.line_numbers[diagnostic.line - 1]
+        origin = self.origins.get(diagnostic.line)
+        if origin is None:
+            return diagnostic._replace(line=line_number)
+        if (origin_line := self.origin_lines.get(diagnostic.line)) is not None:
+            origin = self._get_unit_origin(origin, origin_line)
+        message = diagnostic.message if origin.description is None else f"{origin.description}: {diagnostic.message}"
+        return Diagnostic(diagnostic.severity, message, line_number, origin.column, origin.end_column)
+
+    # the line is given to the passes even when its labels are also constants,
+    # so check reports the rest of the program as usual
+    def _emit(self, line: str, split: tuple[str, str, str, str, str], origin: Origin | None):
+        self.line_numbers.append(self._line_number)
+        if origin is not None:
+            self.origins[len(self.line_numbers)] = origin
+        self._batch.append((line, split))
+        if len(self.line_numbers) > self.max_lines:
+            raise ProgramTooLarge(
+                f"the program has more than {self.max_lines} lines after expanding macros and includes")
+        if split[0]:
+            for label in label_regex.findall(split[0]):
+                if label in self.constants:
+                    self._error(f"Duplicate symbols with name: {label}", origin, line)
+                self.labels.add(label)
+
+    # the labels and comment of a line whose statement is expanded
+    def _emit_rest(self, labels: str, comment: str, origin: Origin | None):
+        if labels or comment:
+            self._emit(*join_source_line(labels, "", "", comment), origin)
+
+    def _get_unit_origin(self, include_origin: Origin, unit_line_number: int) -> Origin:
+        return include_origin._replace(description=f"{include_origin.description} line {unit_line_number}")
+
+    def _get_origin(self, parent: Origin | None, description: str | None, line: str) -> Origin:
+        if parent is not None:
+            if parent.description is not None and description is not None:
+                description = f"{parent.description}, {description}"
+            return Origin(description or parent.description, parent.column, parent.end_column)
+        line_match = source_line_regex.match(line)
+        assert line_match is not None  # every line matches
+        start, end = line_match.span("statement")
+        return Origin(description, start + 1, end + 1)
+
+    def _error(self, message: str, origin: Origin | None, line: str):
+        origin = self._get_origin(origin, None, line)
+        if origin.description is not None:
+            message = f"{origin.description}: {message}"
+        if not self.keep_going:
+            raise LocatedError(message)
+        self.diagnostics.append(Diagnostic(
+            "error", message, self._line_number, origin.column, origin.end_column))
+
+    def _process(self, line: str, split: tuple[str, str, str, str, str], origin: Origin | None):
+        labels, instruction, instruction_name, operand_string, comment = split
+        # most lines are instructions that are given to the passes as they are
+        if instruction_name not in self.macros and self._definition is None and is_plain_line(split) \
+                and (self._constants_regex is None or self._constants_regex.search(operand_string) is None):
+            self._emit(line, split, origin)
+            return
+        try:
+            self._process_statement(line, split, origin)
+        except InvalidInstructionParsed as e:
+            if isinstance(e, (ProgramTooLarge, LocatedError)):
+                raise
+            self._error(str(e), origin, line)
+
+    def _process_statement(self, line: str, split: tuple[str, str, str, str, str], origin: Origin | None):
+        labels, instruction, instruction_name, operand_string, comment = split
+        keyword = instruction_name.lower().removeprefix(".")
+        if self._definition is not None:
+            if keyword == "endm":
+                self._define_macro()
+            elif keyword == "macro":
+                raise InvalidInstructionParsed("macros can't be defined inside a macro")
+            else:
+                location = f"line {self._line_number}" if origin is None or origin.description is None \
+                    else origin.description
+                self._body.append((line, split, location))
+            return
 
-    file_contents: str
-    if file_extension == "mif":
-        file_contents = mif_format(
-            instruction_dict, label_dict, comment_dict, memory)
+        if keyword == "include":
+            if (operand_match := include_operand_regex.fullmatch(operand_string)) is None:
+                raise InvalidInstructionParsed(
+                    f"include needs a file name in quotes, got: {operand_string}")
+            self._emit_rest(labels, comment, origin)
+            self._include(operand_match["name"], origin, line)
+        elif keyword == "macro":
+            if (operand_match := macro_operand_regex.fullmatch(operand_string)) is None:
+                raise InvalidInstructionParsed(
+                    f"macro needs a name and its parameters, got: {operand_string}")
+            name = operand_match["name"]
+            if name in self.macros:
+                raise InvalidInstructionParsed(f"Duplicate macros with name: {name}")
+            parameters = operand_match["parameters"] or ""
+            self._emit_rest(labels, comment, origin)
+            self._definition = (name, [parameter.strip() for parameter in parameters.split(",") if parameter.strip()],
+                                self._line_number, origin, line)
+            self._body = []
+        elif keyword == "endm":
+            raise InvalidInstructionParsed("endm without a macro")
+        elif (equ_match := equ_operand_regex.fullmatch(operand_string)) is not None:
+            if not instruction_name.isidentifier():
+                raise InvalidInstructionParsed(f"invalid constant name {instruction_name}")
+            if instruction_name in self.constants:
+                raise InvalidInstructionParsed(f"Duplicate constants with name: {instruction_name}")
+            if instruction_name in self.labels:
+                raise InvalidInstructionParsed(f"Duplicate symbols with name: {instruction_name}")
+            self._emit_rest(labels, comment, origin)
+            value = self._put_constants(equ_match["value"].strip())
+            self.constants[instruction_name] = value if equ_simple_value_regex.fullmatch(value) else f"({value})"
+            self._constants_regex = re.compile(
+                rf"\b(?:{'|'.join(map(re.escape, self.constants))})\b")
+        else:
+            if self._constants_regex is not None and operand_string:
+                constants_operand_string = self._put_constants(operand_string)
+                if constants_operand_string != operand_string:
+                    origin = self._get_origin(origin, None, line)
+                    line, split = join_source_line(labels, instruction_name, constants_operand_string, comment)
+                    operand_string = constants_operand_string
+
+            if (macro := self.macros.get(instruction_name)) is not None:
+                self._emit_rest(labels, comment, origin)
+                self._expand(macro, operand_string, origin, line)
+            else:
+                self._emit(line, split, origin)
+
+    def _put_constants(self, operand_string: str) -> str:
+        if self._constants_regex is None:
+            return operand_string
+        return self._constants_regex.sub(lambda name_match: self.constants[name_match[0]], operand_string)
+
+    def _include(self, name: str, origin: Origin | None, line: str):
+        path = get_include_path(name)
+        key = os.path.realpath(path)
+        if key in self.included:
+            return
+        self.included.add(key)
+        try:
+            unit = load_include(path)
+        except (OSError, UnicodeDecodeError) as e:
+            raise InvalidInstructionParsed(f"couldn't read include file {name}: {e}")
+        include_origin = self._get_origin(origin, name, line)
+        macros = self.macros
+        for unit_line_number, (unit_line, unit_split, plain) in enumerate(zip(unit.lines, unit.splits, unit.plain), 1):
+            # the same as in _process, with the keywords already looked for
+            if plain and unit_split[2] not in macros and self._definition is None \
+                    and (self._constants_regex is None or self._constants_regex.search(unit_split[3]) is None):
+                self._emit(unit_line, unit_split, include_origin)
+                self.origin_lines[len(self.line_numbers)] = unit_line_number
+            else:
+                self._process(unit_line, unit_split, self._get_unit_origin(include_origin, unit_line_number))
+
+    def _define_macro(self):
+        assert self._definition is not None
+        name, parameters, *_ = self._definition
+        labels = [label for _, split, _ in self._body for label in label_regex.findall(split[0])]
+        names = list(dict.fromkeys(parameters + labels))
+        body: list[tuple[str, tuple[str, str, str, str, str], tuple[str, str, str] | None, str]] = []
+        names_regex = re.compile(rf"\b({'|'.join(map(re.escape, names))})\b") if names else None
+        indexes = {name: index for index, name in enumerate(names)}
+        for line, split, location in self._body:
+            templates = None
+            if names_regex is not None and any(names_regex.search(part) for part in (split[0], split[2], split[3])):
+                templates = (get_macro_template(split[0], names_regex, indexes),
+                             get_macro_template(split[2], names_regex, indexes),
+                             get_macro_template(split[3], names_regex, indexes))
+            body.append((line, split, templates, location))
+        self.macros[name] = Macro(name, parameters, body, labels)
+        self._definition = None
+        self._body = []
+
+    def _expand(self, macro: Macro, operand_string: str, origin: Origin | None, line: str):
+        arguments = [argument.strip() for argument in operand_string.split(",")] if operand_string else []
+        if len(arguments) != len(macro.parameters):
+            raise InvalidInstructionParsed(
+                f"macro {macro.name} takes {len(macro.parameters)} arguments, got {len(arguments)}")
+        if macro.name in self._expanding:
+            raise InvalidInstructionParsed(f"macro {macro.name} is used inside itself")
+        self.expansions += 1
+        if self.expansions > MAX_MACRO_EXPANSIONS:
+            raise InvalidInstructionParsed(
+                f"macros were expanded more than {MAX_MACRO_EXPANSIONS} times")
+
+        # every expansion gets its own copy of the macro's labels
+        values = dict(zip(macro.parameters, arguments))
+        values.update((label, f"{label}__{self.expansions}") for label in macro.labels)
+        values_list = list(values.values())
+        description, column, end_column = self._get_origin(origin, f"macro {macro.name}", line)
+        self._expanding.append(macro.name)
+        try:
+            for body_line, body_split, templates, location in macro.body:
+                if templates is not None:
+                    labels_template, name_template, operands_template = templates
+                    body_line, body_split = join_source_line(
+                        labels_template.format(*values_list), name_template.format(*values_list),
+                        operands_template.format(*values_list), body_split[4])
+                self._process(body_line, body_split, Origin(f"{description} at {location}", column, end_column))
+        finally:
+            self._expanding.pop()
+
+
+# looking for the words in the lowercased source is much faster than the
+# regex, which is only run to rule out longer words like equal
+def uses_preprocessor(code: str) -> bool:
+    lowered = code.lower()
+    if "include" not in lowered and "macro" not in lowered and "endm" not in lowered and "equ" not in lowered:
+        return False
+    return preprocessor_keyword_regex.search(code) is not None
+
+
+# the lines to give the passes and how to split them. the preprocessor is
+# returned when it was used, to find the source line of every line the passes
+# saw
+def preprocess(code: str | Iterable[str], split_line: Callable[[str], tuple[str, str, str, str, str]] = split_source_line, keep_going: bool = False) -> tuple[str | Iterable[str], Callable[[str], tuple[str, str, str, str, str]], Preprocessor | None]:
+    if not isinstance(code, str):
+        preprocessor = Preprocessor(split_line, keep_going)
+        return preprocessor.lines(code), preprocessor.split_passed_line, preprocessor
+    if not uses_preprocessor(code):
+        return code, split_line, None
+    preprocessor = Preprocessor(split_line, keep_going)
+    return preprocessor.expand(code), preprocessor.split_expanded_line, preprocessor
+
+
+SPLIT_LINE_OVERHEAD = 300
+ENCODED_LINE_OVERHEAD = 200
+
+
+class IncrementalAssembler:
+    """Assembles successive revisions of one program, only re-encoding the lines that changed"""
+
+    def __init__(self):
+        self.revision = 0
+        self.lines_encoded = 0  # lines re-encoded by the last call to assemble
+        self._split_lines: dict[str, tuple[str, str, str, str, str]] = {}
+        self._next_split_lines: dict[str, tuple[str, str, str, str, str]] = {}
+        # encoded words are kept per instruction text (and per address for
+        # branches and uses of .) with the values of every label they looked
+        # up and the warnings they gave, which are given again when reused
+        self._encoded: dict[tuple[str, int | None], tuple[tuple[tuple[str, int | None], ...], int | array, tuple[str, ...]]] = {}
+        self._registers = register_names.get()  # the register names the words were encoded with
+        self._lock = threading.Lock()
+        self.size = 0  # about how many bytes the kept lines and words take
+
+    def _split_line(self, line: str) -> tuple[str, str, str, str, str]:
+        split_line = self._split_lines.get(line)
+        if split_line is None:
+            split_line = split_source_line(line)
+        self._next_split_lines[line] = split_line
+        return split_line
+
+    def assemble(self, code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH) -> Assembly:
+        return self.assemble_with_lines(code, depth)[0]
+
+    def assemble_with_lines(self, code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH) -> tuple[Assembly, list[int]]:
+        with self._lock:
+            self._next_split_lines = {}
+            lines, split_line, preprocessor = preprocess(code, self._split_line)
+            labels, instructions, comments, line_numbers = timed_phase(
+                "first_pass", first_pass, lines, split_line, depth)
+            if preprocessor is not None:
+                line_numbers = preprocessor.source_line_numbers(line_numbers)
+            encoded_instructions = timed_phase(
+                "second_pass", self._second_pass, labels, instructions)
+
+            # only keep what this revision used so memory stays bounded by the program size
+            self._split_lines = self._next_split_lines
+            self.size = self._estimate_size()
+            self.revision += 1
+            return (labels, instructions, comments, encoded_instructions), line_numbers
+
+    # each split line keeps its text about twice (the line and its parts) and
+    # each encoded word its instruction text, the containers around them take
+    # a few hundred bytes more per line
+    def _estimate_size(self) -> int:
+        size = sum(SPLIT_LINE_OVERHEAD + 2 * len(line) for line in self._split_lines)
+        for (instruction, _), (_, word, _) in self._encoded.items():
+            size += ENCODED_LINE_OVERHEAD + len(instruction)
+            if isinstance(word, array):
+                size += word.itemsize * len(word)
+        return size
+
+    def _second_pass(self, labels: dict[str, int], instructions: list[tuple[int, str]]) -> list[tuple[int, int]]:
+        if register_names.get() is not self._registers:
+            self._encoded = {}
+            self._registers = register_names.get()
+        recorder = LabelLookupRecorder(labels)
+        encoded: dict[tuple[str, int | None],
+                      tuple[tuple[tuple[str, int | None], ...], int | array, tuple[str, ...]]] = {}
+        encoded_instructions: list[tuple[int, int]] = []
+        lines_encoded = 0
+        for memory_address, instruction in instructions:
+            if not instruction:
+                continue  # the rest of a data directive
+            # branch offsets are relative to the branch's own address, and so
+            # is anything that uses . in its operands
+            name = instruction.split(maxsplit=1)[0]
+            uses_address = name in branch_c2_values or "." in instruction[len(name):]
+            key = (instruction, memory_address if uses_address else None)
+
+            cached = self._encoded.get(key) or encoded.get(key)
+            if cached is not None and name.lower().removeprefix(".") == "incbin":
+                cached = None  # the file can change without the line changing
+            if cached is None or any(labels.get(label) != value for label, value in cached[0]):
+                recorder.lookups = {}
+                with collect_warnings() as warnings:
+                    word = encode_instruction(
+                        instruction, recorder, memory_address)
+                cached = (tuple(recorder.lookups.items()), word, tuple(warnings))
+                lines_encoded += 1
+
+            encoded[key] = cached
+            _, word, warnings = cached
+            for warning in warnings:
+                warn(warning)
+            add_encoded_words(encoded_instructions, memory_address, word)
+
+        self._encoded = encoded
+        self.lines_encoded = lines_encoded
+        return encoded_instructions
+
+
+def build_memory(encoded_instructions: list[tuple[int, int]], depth: int) -> dict[int, int]:
+    # built in one go, an address used twice leaves fewer entries than words
+    memory = dict(encoded_instructions)
+    if max(memory) >= depth:
+        raise Exception("Program too long")
+    if len(memory) != len(encoded_instructions):
+        raise Exception("Program overwrites itself (bad org statement)")
+    return memory
+
+
+class Program:
+    """An assembled program with one entry per word in parallel arrays, every output format is written from it"""
+
+    __slots__ = ("source", "depth", "labels", "encoded_instructions", "memory",
+                 "addresses", "words", "statements", "lines",
+                 "statements_by_address", "labels_by_address", "comments_by_address")
+
+    def __init__(self, source: str | None, assembly: Assembly, line_numbers: list[int], depth: int = DEFAULT_MEMORY_DEPTH):
+        labels, instructions, comments, encoded_instructions = assembly
+        self.source = source  # None when the program was read line by line
+        self.depth = depth
+        self.labels = labels
+        self.encoded_instructions = encoded_instructions
+        self.memory = timed_phase(
+            "build_memory", build_memory, encoded_instructions, depth)
+
+        self.addresses = array("I", [address for address, _ in encoded_instructions])
+        self.words = array(WORD_TYPECODE, [word & 0xFFFFFFFF for _, word in encoded_instructions])
+        self.statements = [statement for _, statement in instructions]
+        self.lines = array("I", line_numbers)
+
+        self.statements_by_address = dict(zip(self.addresses, self.statements))
+        self.labels_by_address: dict[int, list[str]] = {}
+        for label, address in labels.items():
+            self.labels_by_address.setdefault(address, []).append(label)
+        self.comments_by_address: dict[int, list[str]] = {}
+        for address, comment in comments:
+            self.comments_by_address.setdefault(address, []).append(comment)
+
+    # the opcodes and columns are only needed for the source map, so they are
+    # worked out when asked for instead of on every assemble
+
+    def get_opcodes(self) -> array:
+        opcodes = array("b")
+        for statement in self.statements:
+            encoding = instruction_table.get(statement.split(maxsplit=1)[0]) if statement else None
+            opcodes.append(-1 if encoding is None else encoding.opcode)  # -1 for data
+        return opcodes
+
+    def get_columns(self) -> tuple[array, array]:
+        # where each statement starts and one past where it ends, counted from 1
+        source_lines = self.source.splitlines()
+        columns = array("I")
+        end_columns = array("I")
+        for line_number in self.lines:
+            line_match = source_line_regex.match(source_lines[line_number - 1])
+            assert line_match is not None  # every line matches
+            start, end = line_match.span("statement")
+            columns.append(start + 1)
+            end_columns.append(end + 1)
+        return columns, end_columns
+
+
+# the source can be an iterable of lines, like an open file, which is then
+# assembled without ever holding all of it
+def assembly_to_program(file_string: str | Iterable[str], assembler: IncrementalAssembler | None = None, depth: int = DEFAULT_MEMORY_DEPTH) -> Program:
+    if depth < 1:
+        raise InvalidInstructionParsed(f"memory depth must be positive, got {depth}")
+
+    if assembler is None:
+        assembly, line_numbers = assemble_with_lines(file_string, depth)
     else:
-        file_contents = mem_format(
-            instruction_dict, label_dict, comment_dict, memory)
-    return encoded_instructions, file_contents
-
-
-def mem_format(instruction_dict: dict[int, str], label_dict: dict[int, list[str]], comment_dict: dict[int, list[str]], memory: dict[int, int]) -> str:
-    output: str
-    output = "// Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)\n"
-    for i in range(512):
-        if label_list := label_dict.get(i):
-            output += "".join([f"//   {label}:\n" for label in label_list])
-        output += (f"{f'@{i:X}'.rjust(4, ' ')} {memory.get(i, 0):08X}")
-
-        line_comment = ""
-        if instruction := instruction_dict.get(i):
-            line_comment += (f"{instruction.ljust(18)}")
-        if comment_list := comment_dict.get(i):
-            line_comment += f"; {' ; '.join([comment.strip()
-                                            for comment in comment_list])}"
-
-        if line_comment != "":
-            output += f" // {line_comment}"
-        output += "\n"
-    output += ("// Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)")
-    return output
-
-
-def mif_format(instruction_dict: dict[int, str], label_dict: dict[int, list[str]], comment_dict: dict[int, list[str]], memory: dict[int, int]) -> str:
-    output = """-- Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)
+        assembly, line_numbers = assembler.assemble_with_lines(file_string, depth)
+    return Program(file_string if isinstance(file_string, str) else None, assembly, line_numbers, depth)
+
+
+def assembly_to_chunks(file_extension: str, file_string: str | Iterable[str], assembler: IncrementalAssembler | None = None, depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False) -> tuple[list[tuple[int, int]], Iterator[str]]:
+    if file_extension in source_formats and not isinstance(file_string, str):
+        file_string = "\n".join(source_lines(file_string))
+    program = assembly_to_program(file_string, assembler, depth)
+    # formatting is lazy, all the errors have been raised by this point
+    return program.encoded_instructions, text_formatters[file_extension](program, sparse)
+
+
+def assembly_to_file(file_extension: str, file_string: str, assembler: IncrementalAssembler | None = None, depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False) -> tuple[list[tuple[int, int]], str]:
+    encoded_instructions, file_chunks = assembly_to_chunks(
+        file_extension, file_string, assembler, depth, sparse)
+    return encoded_instructions, timed_phase("format", "".join, file_chunks)
+
+
+# addresses that hold a word or get labels or a comment in the output, with the
+# end of memory appended so the run of empty words after the last one is
+# handled the same way
+def used_addresses(program: Program) -> list[int]:
+    addresses = program.memory.keys() | program.labels_by_address.keys() | program.comments_by_address.keys()
+    return sorted(address for address in addresses if 0 <= address < program.depth) + [program.depth]
+
+
+def get_line_comment(address: int, program: Program) -> str:
+    line_comment = ""
+    if instruction := program.statements_by_address.get(address):
+        line_comment += (f"{instruction.ljust(18)}")
+    if comment_list := program.comments_by_address.get(address):
+        line_comment += f"; {' ; '.join([comment.strip()
+                                        for comment in comment_list])}"
+    return line_comment
+
+
+# runs of at least this many empty words are left out of sparse output
+MIN_SPARSE_RUN = 2
+
+
+def get_address_width(depth: int) -> int:
+    return max(3, len(f"{depth - 1:X}"))
+
+
+# the memory is a sparse map, so only the used addresses are visited and empty
+# words are written in runs. sparse output leaves long runs out of mem files
+# (every line already carries its @address) and writes them as a single range
+# in mif files
+def mem_chunks(program: Program, sparse: bool = False) -> Iterator[str]:
+    yield "// Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)\n"
+    depth = program.depth
+    address_format = f"%{get_address_width(depth) + 1}s"
+    i = 0
+    for used_address in used_addresses(program):
+        # empty words have nothing to look up
+        if i < used_address and not (sparse and used_address - i >= MIN_SPARSE_RUN):
+            empty_word = address_format + " 00000000\n"
+            yield "".join([empty_word % f"@{address:X}"
+                           for address in range(i, used_address)])
+        i = used_address
+        if i == depth:
+            break
+
+        if label_list := program.labels_by_address.get(i):
+            yield "".join([f"//   {label}:\n" for label in label_list])
+        line = f"{address_format} %08X" % (f"@{i:X}", program.memory.get(i, 0))
+        if line_comment := get_line_comment(i, program):
+            line += f" // {line_comment}"
+        yield line + "\n"
+        i += 1
+    yield "// Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)"
+
+
+def mem_format(program: Program, sparse: bool = False) -> str:
+    return "".join(mem_chunks(program, sparse))
+
+
+def mif_chunks(program: Program, sparse: bool = False) -> Iterator[str]:
+    depth = program.depth
+    yield f"""-- Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)
 WIDTH=32;
-DEPTH=512;
+DEPTH={depth};
  
 ADDRESS_RADIX=HEX;
 DATA_RADIX=HEX;
  
 CONTENT BEGIN
 """
-    for i in range(512):
-        if label_list := label_dict.get(i):
-            output += "".join([f"--   {label}:\n" for label in label_list])
-        output += (f"{f'{i:X}'.rjust(3, ' ')}: {memory.get(i, 0):08X};")
-
-        line_comment = ""
-        if instruction := instruction_dict.get(i):
-            line_comment += (f"{instruction.ljust(18)}")
-        if comment_list := comment_dict.get(i):
-            line_comment += f"; {' ; '.join([comment.strip()
-                                            for comment in comment_list])}"
-
-        if line_comment != "":
-            output += f" -- {line_comment}"
-        output += "\n"
-    output += "END;\n"
-    output += "-- Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)\n"
-    return output
+    address_width = get_address_width(depth)
+    i = 0
+    for used_address in used_addresses(program):
+        # empty words have nothing to look up
+        if sparse and used_address - i >= MIN_SPARSE_RUN:
+            yield f"{f'[{i:X}..{used_address - 1:X}]':>{address_width}}: 00000000;\n"
+        elif i < used_address:
+            yield "".join([f"{address:{address_width}X}: 00000000;\n"
+                           for address in range(i, used_address)])
+        i = used_address
+        if i == depth:
+            break
+
+        if label_list := program.labels_by_address.get(i):
+            yield "".join([f"--   {label}:\n" for label in label_list])
+        line = f"{i:{address_width}X}: {program.memory.get(i, 0):08X};"
+        if line_comment := get_line_comment(i, program):
+            line += f" -- {line_comment}"
+        yield line + "\n"
+        i += 1
+    yield "END;\n"
+    yield "-- Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)\n"
+
+
+def mif_format(program: Program, sparse: bool = False) -> str:
+    return "".join(mif_chunks(program, sparse))
+
+
+# what the mem and mif formats need to be written by a client (like the
+# website) without sending their empty words: the addresses that get a line
+# with their word, labels and comment. the runs of empty words between them
+# are written in full, or left out like mem_chunks and mif_chunks do when they
+# are at least skip_runs long
+def sparse_output(program: Program, sparse: bool = False) -> dict:
+    addresses = used_addresses(program)[:-1]
+    return {
+        "depth": program.depth,
+        "skip_runs": MIN_SPARSE_RUN if sparse else None,
+        "addresses": addresses,
+        "words": [program.memory.get(address, 0) for address in addresses],
+        "labels": {str(address): program.labels_by_address[address]
+                   for address in addresses if address in program.labels_by_address},
+        "comments": [get_line_comment(address, program) for address in addresses],
+    }
+
+
+# every source line next to the addresses and words it assembled to, then the
+# labels. sparse has no effect
+def lst_chunks(program: Program, sparse: bool = False) -> Iterator[str]:
+    yield "; Created with SRC-ASM (https://github.com/davlaf/elec374-assembler)\n"
+    source_lines = program.source.splitlines()
+    address_width = get_address_width(program.depth)
+    address_column = max(4, address_width)
+    line_width = max(4, len(str(len(source_lines))))
+    yield f"; {'ADDR':<{address_column}}  WORD      {'LINE':>{line_width}}  SOURCE\n"
+
+    # every word of each source line, data directives, macro calls and
+    # includes have more than one. the ones after the first get a row of their own
+    line_indexes: dict[int, list[int]] = {}
+    for index, line_number in enumerate(program.lines):
+        line_indexes.setdefault(line_number, []).append(index)
+    no_statement = " " * (address_column + 14)
+    for line_number, line in enumerate(source_lines, 1):
+        indexes = line_indexes.get(line_number)
+        if indexes is None:
+            yield f"{no_statement}{line_number:>{line_width}}  {line}\n"
+            continue
+        for position, index in enumerate(indexes):
+            address = f"{program.addresses[index]:0{address_width}X}"
+            row = f"  {address:<{address_column}}  {program.words[index]:08X}"
+            yield f"{row}  {line_number:>{line_width}}  {line}\n" if position == 0 else f"{row}\n"
+
+    if program.labels:
+        yield ";\n; labels\n"
+        yield "".join([f";   {address:0{address_width}X}  {label}\n"
+                       for label, address in sorted(program.labels.items(), key=lambda item: item[1])])
+
+
+# the statements of the program as parallel lists, for tools that map an
+# address back to its source (lines and columns count from 1, end_columns are
+# one past the statement). sparse has no effect
+def map_chunks(program: Program, sparse: bool = False) -> Iterator[str]:
+    columns, end_columns = program.get_columns()
+    yield json.dumps({
+        "version": 1,
+        "depth": program.depth,
+        "addresses": program.addresses.tolist(),
+        "words": program.words.tolist(),
+        "opcodes": program.get_opcodes().tolist(),
+        "lines": program.lines.tolist(),
+        "columns": columns.tolist(),
+        "end_columns": end_columns.tolist(),
+        "labels": program.labels,
+    })
+    yield "\n"
+
+
+text_formatters: dict[str, Callable[[Program, bool], Iterator[str]]] = {
+    "mem": mem_chunks,
+    "mif": mif_chunks,
+    "lst": lst_chunks,
+    "map": map_chunks,
+}
+
+
+def memory_image(memory: dict[int, int], depth: int, little_endian: bool = False) -> memoryview:
+    image = array(WORD_TYPECODE, bytes(4 * depth))
+    for address, word in memory.items():
+        image[address] = word & 0xFFFFFFFF
+    if little_endian != (sys.byteorder == "little"):
+        image.byteswap()
+    return memoryview(image).cast("B")
+
+
+# one record per 32 bit word addressed by word, the layout quartus uses for
+# memory initialization files
+def intel_hex_chunks(image: memoryview, sparse: bool = False) -> Iterator[str]:
+    upper_address = 0
+    for address in range(len(image) // 4):
+        word = image[4 * address:4 * address + 4]
+        if sparse and not any(word):
+            continue
+        # addresses past 16 bits need an extended linear address record first
+        if address >> 16 != upper_address:
+            upper_address = address >> 16
+            record = bytes((2, 0, 0, 4, upper_address >> 8, upper_address & 0xFF))
+            yield f":{record.hex().upper()}{-sum(record) & 0xFF:02X}\n"
+        record = bytes((4, (address >> 8) & 0xFF, address & 0xFF, 0)) + word
+        yield f":{record.hex().upper()}{-sum(record) & 0xFF:02X}\n"
+    yield ":00000001FF\n"
+
+
+def assembly_to_image(file_extension: str, file_string: str | Iterable[str], assembler: IncrementalAssembler | None = None, depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False) -> tuple[list[tuple[int, int]], bytes]:
+    program = assembly_to_program(file_string, assembler, depth)
+    return program.encoded_instructions, timed_phase("format", format_image, file_extension, program.memory, depth, sparse, little_endian)
+
+
+def format_image(file_extension: str, memory: dict[int, int], depth: int, sparse: bool = False, little_endian: bool = False) -> bytes:
+    # the hex formats always list each word most significant byte first
+    image = memory_image(
+        memory, depth, little_endian and file_extension == "bin")
+    if file_extension == "bin":
+        return image.tobytes()
+    if file_extension == "hex":
+        return "".join(intel_hex_chunks(image, sparse)).encode("ascii")
+    return image.hex("\n", 4).upper().encode("ascii") + b"\n"
+
+
+class AssemblyResult(NamedTuple):
+    """An assembled program, its output in the format asked for (None if there wasn't one) and the warnings it gave"""
+    program: Program
+    output: str | bytes | None
+    warnings: list[str]
+
+
+class Assembler:
+    """Assembles for one ISA variant, returning the warnings with each result instead of printing them. It is never changed after being made, so one can be shared by every thread"""
+
+    def __init__(self, variant: str = "lab", library: str | None = None, max_lines: int = MAX_EXPANDED_LINES):
+        if variant not in isa_variants:
+            raise ValueError(f"unknown ISA variant {variant}, expected one of {', '.join(isa_variants)}")
+        self.variant = variant
+        self.registers = isa_variants[variant]
+        self.library = library  # the directory include finds files in
+        self.max_lines = max_lines  # after expanding macros and includes
+
+    # uses this variant's registers and library and collects the warnings of
+    # whatever runs inside, like SRC_SIM.simulate
+    @contextmanager
+    def session(self) -> Iterator[list[str]]:
+        token = register_names.set(self.registers)
+        try:
+            with collect_warnings() as warnings, include_library_from(self.library), \
+                    limit_program_lines(self.max_lines):
+                yield warnings
+        finally:
+            register_names.reset(token)
+
+    def assemble(self, code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH, incremental: IncrementalAssembler | None = None) -> AssemblyResult:
+        with self.session() as warnings:
+            program = assembly_to_program(code, incremental, depth)
+        return AssemblyResult(program, None, warnings)
+
+    def assemble_to(self, file_extension: str, code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False, incremental: IncrementalAssembler | None = None) -> AssemblyResult:
+        output: str | bytes
+        if file_extension in source_formats and not isinstance(code, str):
+            code = "\n".join(source_lines(code))
+        with self.session() as warnings:
+            program = assembly_to_program(code, incremental, depth)
+            if file_extension in image_formats:
+                output = timed_phase("format", format_image, file_extension,
+                                     program.memory, depth, sparse, little_endian)
+            else:
+                output = timed_phase("format", "".join,
+                                     text_formatters[file_extension](program, sparse))
+        return AssemblyResult(program, output, warnings)
+
+    # the warnings are diagnostics too
+    def check(self, code: str | Iterable[str], depth: int = DEFAULT_MEMORY_DEPTH) -> list[Diagnostic]:
+        with self.session():
+            return check(code, depth)
+
+
+def get_output_filename(input_filename: str, file_extension: str) -> str:
+    if match := re.match(r"^(.*)\..*?$", input_filename):
+        return f"{match.groups()[0]}.{file_extension}"
+    return f"{input_filename}.{file_extension}"
+
+
+def expand_input_filenames(patterns: list[str]) -> list[str]:
+    # shells on windows don't expand globs, so do it here
+    filenames: list[str] = []
+    for pattern in patterns:
+        if any(character in pattern for character in "*?["):
+            filenames.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            filenames.append(pattern)
+    return filenames
+
+
+# incbin paths are relative to the source file
+def get_source_directory(input_filename: str) -> str:
+    return os.path.dirname(os.path.abspath(input_filename))
+
+
+# the source is assembled as it's read, so only the program is kept in memory
+def assemble_file(input_filename: str, output_filename: str, file_extension: str, depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False) -> list[tuple[int, int]]:
+    with open(input_filename, "r", encoding="utf8") as source_file, include_files_from(get_source_directory(input_filename)):
+        if file_extension in image_formats:
+            encoded_instructions, image = assembly_to_image(
+                file_extension, source_file, depth=depth, sparse=sparse, little_endian=little_endian)
+            with open(output_filename, "wb") as f:
+                f.write(image)
+            return encoded_instructions
+
+        encoded_instructions, file_chunks = assembly_to_chunks(
+            file_extension, source_file, depth=depth, sparse=sparse)
+
+    with open(output_filename, "w", encoding="ascii", errors="ignore") as f:
+        f.writelines(file_chunks)
+
+    return encoded_instructions
+
+
+def assembly_to_output(file_extension: str, file_string: str, assembler: IncrementalAssembler | None = None, depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False) -> tuple[list[tuple[int, int]], bytes]:
+    if file_extension in image_formats:
+        return assembly_to_image(file_extension, file_string, assembler, depth, sparse, little_endian)
+    encoded_instructions, file_text = assembly_to_file(
+        file_extension, file_string, assembler, depth, sparse)
+    return encoded_instructions, file_text.encode("ascii", errors="ignore")
+
+
+# returns whether the file was written. the output goes to a temporary file
+# that replaces the old one, so a simulator watching it never reads half of it
+def write_if_changed(output_filename: str, data: bytes) -> bool:
+    mode = 0o644
+    try:
+        with open(output_filename, "rb") as f:
+            if f.read() == data:
+                return False
+            mode = os.stat(f.fileno()).st_mode & 0o777
+    except FileNotFoundError:
+        pass
+
+    directory = os.path.dirname(os.path.abspath(output_filename))
+    with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".", suffix=".tmp", delete=False) as f:
+        temporary_filename = f.name
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            # temporary files are only readable by their owner
+            os.chmod(temporary_filename, mode)
+        except BaseException:
+            f.close()
+            os.unlink(temporary_filename)
+            raise
+    os.replace(temporary_filename, output_filename)
+    return True
+
+
+def run_simulation(encoded_instructions: list[tuple[int, int]], depth: int, input_port: int, max_steps: int):
+    import SRC_SIM  # imports this module, so only when needed
+    simulator = SRC_SIM.Simulator(build_memory(
+        encoded_instructions, depth), depth, input_port)
+    try:
+        simulator.run(max_steps)
+    except SRC_SIM.SimulationError as e:
+        print(f"Error when simulating: {e}")
+    print(SRC_SIM.format_state(simulator))
+
+
+# stays resident and reassembles each source when it changes. every file keeps
+# its own incremental assembler, so only the lines that changed are encoded
+def watch_files(jobs: list[tuple[str, str, str, int, bool, bool]], interval: float = 0.25, on_assembled: Callable[[list[tuple[int, int]]], None] | None = None, is_verbose: bool = False):
+    assemblers = {input_filename: IncrementalAssembler()
+                  for input_filename, *_ in jobs}
+    last_seen: dict[str, tuple[int, int] | None] = {}
+    while True:
+        for input_filename, output_filename, file_extension, depth, sparse, little_endian in jobs:
+            try:
+                stat = os.stat(input_filename)
+                seen = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                seen = None
+            if input_filename in last_seen and last_seen[input_filename] == seen:
+                continue
+            last_seen[input_filename] = seen
+            if seen is None:
+                print(f"Waiting for {input_filename} to exist")
+                continue
+
+            try:
+                with open(input_filename, "r", encoding="utf8") as f:
+                    file_string = f.read()
+                with include_files_from(get_source_directory(input_filename)):
+                    encoded_instructions, data = assembly_to_output(
+                        file_extension, file_string, assemblers[input_filename], depth, sparse, little_endian)
+            except Exception as e:
+                if is_verbose:
+                    traceback.print_exc()
+                print(f"Error when assembling {input_filename}: {e}")
+                continue
+
+            if write_if_changed(output_filename, data):
+                print(f"Successfully wrote {
+                      len(encoded_instructions)} data words to {output_filename}")
+            else:
+                print(f"{output_filename} is unchanged")
+            if on_assembled is not None:
+                on_assembled(encoded_instructions)
+        time.sleep(interval)
+
+
+# runs in the batch worker processes, so errors are returned instead of raised
+# to keep one bad file from aborting the others
+def assemble_file_job(input_filename: str, output_filename: str, file_extension: str, depth: int = DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False) -> tuple[list[tuple[int, int]] | None, str | None, str | None]:
+    try:
+        return assemble_file(input_filename, output_filename, file_extension, depth, sparse, little_endian), None, None
+    except Exception as e:
+        return None, str(e), traceback.format_exc()
+
+
+def run_batch(function: Callable, argument_lists: list[tuple], max_workers: int | None = None) -> list:
+    if len(argument_lists) <= 1 or max_workers == 1:
+        return [function(*arguments) for arguments in argument_lists]
+
+    workers = max_workers or os.cpu_count() or 1
+    # hand files out in chunks so small files don't pay a round trip each
+    chunksize = max(1, len(argument_lists) // (workers * 4))
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(function, *zip(*argument_lists), chunksize=chunksize))
 
 
 def main():
+    # python SRC_ASM.py disassemble <image> ... goes to the disassembler
+    if sys.argv[1:2] == ["disassemble"]:
+        import SRC_DIS  # imports this module, so only when needed
+        SRC_DIS.main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         prog='ELEC374 MiniSRC Assembler',
-        usage='python SRC-ASM.py <input path> -o <output path> -t [mem|mif]',
+        usage='python SRC-ASM.py <input path> [<input path> ...] -o <output path> -t [mem|mif|bin|hex|vhex] -d <memory depth> [-s] [-e big|little] [--run] [--watch] [--check]',
         description='Takes an assembly file and produces a hex dump of the encoded instructions, with syntax supported by modelsim to allow it to be added into the memory with the $readmemh',
         epilog='Contact asmhelp@davlaf.com if you have questions or to report bugs, or raise a github Issue')
 
-    parser.add_argument('filename')  # input filename
+    parser.add_argument('filenames', nargs='+')  # input filenames or globs
     parser.add_argument('-o', '--output')      # output filename
     parser.add_argument('-v', '--verbose',
                         action='store_true')  # on/off flag
-    parser.add_argument('-t', '--type', default="mem", choices=["mem", "mif"])
+    parser.add_argument('-t', '--type', default="mem", choices=output_formats)
+    parser.add_argument('-j', '--jobs', type=int)  # worker processes for batches
+    parser.add_argument('-d', '--depth', type=int,
+                        default=DEFAULT_MEMORY_DEPTH)  # words of memory
+    parser.add_argument('-s', '--sparse',
+                        action='store_true')  # leave out runs of empty words
+    parser.add_argument('-e', '--endian', default="big",
+                        choices=["big", "little"])  # byte order of bin output
+    parser.add_argument('--run', action='store_true')  # simulate after assembling
+    parser.add_argument('--max-steps', type=int, default=1_000_000)
+    parser.add_argument('--input', type=lambda value: int(value, 0),
+                        default=0)  # value read by the in instruction
+    parser.add_argument('-c', '--check',
+                        action='store_true')  # report every error, write nothing
+    parser.add_argument('-w', '--watch',
+                        action='store_true')  # reassemble when the inputs change
+    parser.add_argument('--interval', type=float,
+                        default=0.25)  # seconds between checks when watching
     args = parser.parse_args()
-    input_filename: str = args.filename
     file_extension: str = args.type
     is_verbose: bool = args.verbose
-
-    try:
-        if args.output is None:
-            if match := re.match(r"^(.*)\..*?$", input_filename):
-                output_filename = f"{match.groups()[0]}.{file_extension}"
+    if args.depth < 1:
+        parser.error("--depth must be positive")
+
+    input_filenames = expand_input_filenames(args.filenames)
+    if len(input_filenames) == 0:
+        parser.error("no input files matched")
+
+    if args.check:
+        problems = 0
+        has_errors = False
+        for input_filename in input_filenames:
+            try:
+                with open(input_filename, "r", encoding="utf8") as f, include_files_from(get_source_directory(input_filename)):
+                    diagnostics = check(f, args.depth)
+            except OSError as e:
+                diagnostics = [Diagnostic("error", str(e), 1, 1, 1)]
+            for diagnostic in diagnostics:
+                print(format_diagnostic(input_filename, diagnostic))
+                has_errors = has_errors or diagnostic.severity == "error"
+            problems += len(diagnostics)
+        print(f"Found {problems} problem{'' if problems == 1 else 's'} in {len(input_filenames)} file{'' if len(input_filenames) == 1 else 's'}")
+        # warnings alone still pass, so the check can be used in scripts and CI
+        if has_errors:
+            sys.exit(1)
+        return
+
+    if args.output is None:
+        output_filenames = [get_output_filename(input_filename, file_extension)
+                            for input_filename in input_filenames]
+    else:
+        if len(input_filenames) > 1:
+            parser.error("-o/--output can only be used with a single input file")
+        output_filename: str = args.output
+        output_filenames = [output_filename]
+        # check if the file extension is different from the type argument
+        if match := re.match(r"^.*\.(.*?)$", args.output):
+            output_filename_file_extension = match.groups()[0]
+            if output_filename_file_extension != file_extension:
+                print(
+                    "Warning: Output filename and specified file type don't match")
+
+    jobs = [(input_filename, output_filename, file_extension, args.depth, args.sparse, args.endian == "little")
+            for input_filename, output_filename in zip(input_filenames, output_filenames)]
+
+    if args.watch:
+        def on_assembled(encoded_instructions: list[tuple[int, int]]):
+            if args.run:
+                run_simulation(encoded_instructions,
+                               args.depth, args.input, args.max_steps)
+        print(f"Watching {len(jobs)} file{'s' if len(jobs) > 1 else ''}, press Ctrl+C to stop")
+        try:
+            watch_files(jobs, args.interval, on_assembled, is_verbose)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    results = run_batch(assemble_file_job, jobs, args.jobs)
+
+    failures = 0
+    for (input_filename, output_filename, *_), (encoded_instructions, error, error_traceback) in zip(jobs, results):
+        if encoded_instructions is None:
+            failures += 1
+            if is_verbose:
+                print(error_traceback)
+            elif len(jobs) > 1:
+                print(f"Error when assembling {input_filename}: {error}")
             else:
-                output_filename = f"{input_filename}.{file_extension}"
-        else:
-            output_filename: str = args.output
-            # check if the file extension is different from the type argument
-            if match := re.match(r"^.*\.(.*?)$", args.output):
-                output_filename_file_extension = match.groups()[0]
-                if output_filename_file_extension != file_extension:
-                    print(
-                        "Warning: Output filename and specified file type don't match")
-
-        file_string: str
-        with open(input_filename, "r", encoding="utf8") as f:
-            file_string = f.read()
-
-        encoded_instructions, file_contents = assembly_to_file(
-            file_extension, file_string)
+                print(f"Error when assembling: {error}")
+            continue
 
         if is_verbose:
             for instruction_number, instruction in encoded_instructions:
                 print(f"{instruction_number:02X} {instruction:08X}")
 
-        with open(output_filename, "w") as f:
-            f.write(file_contents.encode("ascii", errors="ignore").decode())
-
         # not necessarily instructions if the word directive is used
         print(f"Successfully wrote {
               len(encoded_instructions)} data words to {output_filename}")
-    except Exception as e:
-        if is_verbose:
-            print(traceback.format_exc())
-        else:
-            print(f"Error when assembling: {e}")
+
+        if args.run:
+            run_simulation(encoded_instructions, args.depth,
+                           args.input, args.max_steps)
+
+    if len(jobs) > 1:
+        print(f"Assembled {len(jobs) - failures} of {len(jobs)} files")
+    # so scripts running a batch can tell it didn't all assemble
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,399 @@
+import re
+import sys
+import argparse
+import traceback
+from array import array
+from functools import lru_cache
+from typing import Callable
+
+import SRC_ASM
+
+
+class DisassemblyError(Exception):
+    pass
+
+
+# reverse tables of the assembler's, the branches share one opcode and are
+# told apart by their c2 field
+opcode_names = {opcode: name for name, opcode in SRC_ASM.opcodes.items()
+                if name not in SRC_ASM.branch_c2_values}
+branch_names = {c2: name for name, c2 in SRC_ASM.branch_c2_values.items()}
+register_names = {number: name for name, number in SRC_ASM.register_mapping.items()
+                  if re.fullmatch(r"r\d+", name)}
+
+# the formats read_image reads back, listings and source maps are only written
+input_formats = ["mem", "mif", "bin", "hex", "vhex"]
+input_extensions = {"mem": "mem", "mif": "mif", "bin": "bin", "hex": "hex", "vhex": "vhex",
+                    "txt": "mem", "dat": "mem"}
+
+
+def signed_constant(word: int) -> int:
+    constant = word & 0x7FFFF
+    return constant - 0x80000 if constant & 0x40000 else constant
+
+
+# constants are written in a form get_constant reads back to the same bits
+def format_constant(constant: int, prefer_hex: bool) -> str:
+    if constant < 0 or not prefer_hex:
+        return str(constant)
+    return f"0x{constant:X}"
+
+
+def format_offset_reg(constant: int, rb: int) -> str:
+    offset = format_constant(constant, True)
+    # r0 as the base is the same as leaving it out
+    return f"{offset}({register_names[rb]})" if rb else offset
+
+
+# formatters return None when the word has bits set that the instruction
+# doesn't use, so every line assembles back to the exact same word
+def format_reg_reg_reg(name: str, word: int) -> str | None:
+    if word & 0x7FFF:
+        return None
+    return f"{name} {register_names[(word >> 23) & 0xF]}, {register_names[(word >> 19) & 0xF]}, {register_names[(word >> 15) & 0xF]}"
+
+
+def format_reg_reg_const(name: str, word: int) -> str | None:
+    return f"{name} {register_names[(word >> 23) & 0xF]}, {register_names[(word >> 19) & 0xF]}, {format_constant(signed_constant(word), name != 'addi')}"
+
+
+def format_reg_const(name: str, word: int) -> str | None:
+    branch_name = branch_names.get((word >> 19) & 0xF)
+    if branch_name is None:
+        return None
+    return f"{branch_name} {register_names[(word >> 23) & 0xF]}, {signed_constant(word)}"
+
+
+def format_reg(name: str, word: int) -> str | None:
+    if word & 0x7FFFFF:
+        return None
+    return f"{name} {register_names[(word >> 23) & 0xF]}"
+
+
+def format_reg_reg(name: str, word: int) -> str | None:
+    if word & 0x7FFFF:
+        return None
+    return f"{name} {register_names[(word >> 23) & 0xF]}, {register_names[(word >> 19) & 0xF]}"
+
+
+def format_reg_offset_reg(name: str, word: int) -> str | None:
+    return f"{name} {register_names[(word >> 23) & 0xF]}, {format_offset_reg(signed_constant(word), (word >> 19) & 0xF)}"
+
+
+def format_offset_reg_reg(name: str, word: int) -> str | None:
+    return f"{name} {format_offset_reg(signed_constant(word), (word >> 19) & 0xF)}, {register_names[(word >> 23) & 0xF]}"
+
+
+def format_no_args(name: str, word: int) -> str | None:
+    if word & 0x7FFFFFF:
+        return None
+    return name
+
+
+Formatter = Callable[[str, int], str | None]
+
+# the assembler's encoder for a format -> the formatter that undoes it
+formatters: dict[SRC_ASM.Encoder, Formatter] = {
+    SRC_ASM.encode_reg_reg_reg: format_reg_reg_reg,
+    SRC_ASM.encode_reg_reg_const: format_reg_reg_const,
+    SRC_ASM.encode_reg_const: format_reg_const,
+    SRC_ASM.encode_reg: format_reg,
+    SRC_ASM.encode_reg_reg: format_reg_reg,
+    SRC_ASM.encode_no_args: format_no_args,
+}
+
+
+def build_decoder_table() -> list[tuple[str, Formatter] | None]:
+    table: list[tuple[str, Formatter] | None] = [None] * 32
+    for names, _, _, encoder in SRC_ASM.instruction_formats:
+        for name in names:
+            opcode = SRC_ASM.opcodes[name]
+            if encoder is SRC_ASM.encode_offset_reg:
+                # ld and ldi put the register first, st puts it last
+                formatter = format_offset_reg_reg if name in SRC_ASM.offset_reg_reg else format_reg_offset_reg
+            else:
+                formatter = formatters[encoder]
+            table[opcode] = (opcode_names.get(opcode, name), formatter)
+    return table
+
+
+# opcode -> (instruction name, formatter)
+decoder_table = build_decoder_table()
+
+
+# images repeat the same words a lot (and a term of submissions even more),
+# and the text of a word doesn't depend on its address
+@lru_cache(maxsize=1 << 16)
+def disassemble_word(word: int) -> str:
+    decoder = decoder_table[word >> 27]
+    if decoder is not None:
+        name, formatter = decoder
+        if (statement := formatter(name, word)) is not None:
+            return statement
+    return f"word 0x{word:08X}"
+
+
+def get_branch_target(word: int, address: int) -> int | None:
+    if word >> 27 != SRC_ASM.opcodes["brzr"] or (word >> 19) & 0xF not in branch_names:
+        return None
+    return address + 1 + signed_constant(word)
+
+
+def check_word(address: int, word: int, depth: int) -> None:
+    if not 0 <= address < depth:
+        raise DisassemblyError(
+            f"address {address:X} is outside of the memory depth of {depth}")
+    if not 0 <= word <= 0xFFFFFFFF:
+        raise DisassemblyError(f"value at {address:X} is wider than 32 bits")
+
+
+readmemh_comment_regex = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+# mem and vhex files, anything $readmemh reads
+def read_readmemh(text: str, depth: int) -> dict[int, int]:
+    memory: dict[int, int] = {}
+    address = 0
+    try:
+        for token in readmemh_comment_regex.sub(" ", text).split():
+            if token[0] == "@":
+                address = int(token[1:], 16)
+                continue
+            word = int(token, 16)
+            check_word(address, word, depth)
+            memory[address] = word
+            address += 1
+    except ValueError as e:
+        raise DisassemblyError(f"could not read hex value: {e}")
+    return memory
+
+
+mif_comment_regex = re.compile(r"--[^\n]*|%[^%]*%")
+mif_content_regex = re.compile(r"CONTENT\s+BEGIN(?P<content>.*?)END\s*;", re.IGNORECASE | re.DOTALL)
+mif_setting_regex = re.compile(r"(?P<name>\w+)\s*=\s*(?P<value>\w+)\s*;")
+mif_entry_regex = re.compile(
+    r"^\s*(?:\[\s*(?P<first>\w+)\s*\.\.\s*(?P<last>\w+)\s*\]|(?P<address>\w+))\s*:\s*(?P<values>[\w\s-]*?)\s*$")
+mif_radixes = {"HEX": 16, "DEC": 10, "UNS": 10, "OCT": 8, "BIN": 2}
+
+
+def read_mif(text: str, depth: int) -> dict[int, int]:
+    text = mif_comment_regex.sub(" ", text)
+    content_match = mif_content_regex.search(text)
+    if content_match is None:
+        raise DisassemblyError("no CONTENT BEGIN ... END; section in mif file")
+
+    settings = {match["name"].upper(): match["value"].upper()
+                for match in mif_setting_regex.finditer(text, 0, content_match.start())}
+    if settings.get("WIDTH", "32") != "32":
+        raise DisassemblyError(f"mif word width is {settings['WIDTH']}, not 32")
+    address_radix = mif_radixes.get(settings.get("ADDRESS_RADIX", "HEX"))
+    data_radix = mif_radixes.get(settings.get("DATA_RADIX", "HEX"))
+    if address_radix is None or data_radix is None:
+        raise DisassemblyError("unsupported mif radix")
+
+    memory: dict[int, int] = {}
+    try:
+        for entry in content_match["content"].split(";"):
+            if not entry.strip():
+                continue
+            entry_match = mif_entry_regex.match(entry)
+            if entry_match is None:
+                raise DisassemblyError(f"could not read mif entry: {entry.strip()}")
+            # negative decimal data is stored as two's complement
+            values = [int(value, data_radix) & 0xFFFFFFFF if data_radix == 10 else int(value, data_radix)
+                      for value in entry_match["values"].split()]
+            if entry_match["address"] is not None:
+                # several values after one address fill the following words
+                addresses = range(int(entry_match["address"], address_radix),
+                                  int(entry_match["address"], address_radix) + len(values))
+            else:
+                addresses = range(int(entry_match["first"], address_radix),
+                                  int(entry_match["last"], address_radix) + 1)
+                # a range of empty words is what sparse output writes
+                if not any(values):
+                    check_word(addresses[-1], 0, depth)
+                    continue
+            for i, address in enumerate(addresses):
+                word = values[i % len(values)]
+                check_word(address, word, depth)
+                memory[address] = word
+    except (ValueError, IndexError) as e:
+        raise DisassemblyError(f"could not read mif value: {e}")
+    return memory
+
+
+def read_intel_hex(text: str, depth: int) -> dict[int, int]:
+    memory: dict[int, int] = {}
+    upper_address = 0
+    for line in text.split():
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            record = b""
+        if line[0] != ":" or len(record) < 5 or len(record) != record[0] + 5:
+            raise DisassemblyError(f"invalid intel hex record: {line}")
+        if sum(record) & 0xFF:
+            raise DisassemblyError(f"checksum mismatch in intel hex record: {line}")
+
+        length, record_type, data = record[0], record[3], record[4:-1]
+        if record_type == 0x01:
+            break
+        if record_type == 0x04:
+            upper_address = int.from_bytes(data, "big") << 16
+        elif record_type == 0x00:
+            if length % 4:
+                raise DisassemblyError(f"intel hex record is not whole words: {line}")
+            # word addressed, like intel_hex_chunks writes
+            address = upper_address + (record[1] << 8 | record[2])
+            for i in range(0, length, 4):
+                word = int.from_bytes(data[i:i + 4], "big")
+                check_word(address, word, depth)
+                memory[address] = word
+                address += 1
+    return memory
+
+
+def read_binary(data: bytes, depth: int, little_endian: bool = False) -> dict[int, int]:
+    if len(data) % 4:
+        raise DisassemblyError(f"binary image is {len(data)} bytes, not a whole number of words")
+    if len(data) // 4 > depth:
+        raise DisassemblyError(
+            f"binary image has {len(data) // 4} words, more than the memory depth of {depth}")
+    image = array(SRC_ASM.WORD_TYPECODE, data)
+    if little_endian != (sys.byteorder == "little"):
+        image.byteswap()
+    return dict(enumerate(image))
+
+
+def read_image(file_format: str, data: bytes, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, little_endian: bool = False) -> dict[int, int]:
+    if file_format == "bin":
+        return read_binary(data, depth, little_endian)
+
+    text = data.decode("ascii", errors="replace")
+    if file_format == "mif":
+        return read_mif(text, depth)
+    # packed hex files for $readmemh are often named .hex too
+    if file_format == "hex" and text.lstrip().startswith(":"):
+        return read_intel_hex(text, depth)
+    return read_readmemh(text, depth)
+
+
+# the listing is source that assembles back to the same memory, with the
+# address and word of every line in its comment. empty words are left out
+def disassemble_memory(memory: dict[int, int]) -> str:
+    lines = ["; Disassembled with SRC-ASM (https://github.com/davlaf/elec374-assembler)"]
+    addresses = sorted(address for address, word in memory.items() if word)
+    address_width = SRC_ASM.get_address_width(addresses[-1] + 1 if addresses else 1)
+    next_address = 0
+    for address in addresses:
+        if address != next_address:
+            lines.append(f"org 0x{address:X}")
+        word = memory[address]
+        line = f"        {disassemble_word(word):<28}; {address:0{address_width}X}: {word:08X}"
+        if (target := get_branch_target(word, address)) is not None:
+            line += f" -> {target:X}"
+        lines.append(line)
+        next_address = address + 1
+    lines.append("")
+    return "\n".join(lines)
+
+
+def disassemble_image(file_format: str, data: bytes, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, little_endian: bool = False) -> tuple[dict[int, int], str]:
+    memory = read_image(file_format, data, depth, little_endian)
+    return memory, disassemble_memory(memory)
+
+
+def get_input_format(input_filename: str) -> str:
+    extension = input_filename.rsplit(".", 1)[-1].lower()
+    file_format = input_extensions.get(extension)
+    if file_format is None:
+        raise DisassemblyError(
+            f"can't tell the format of {input_filename}, give it with -t")
+    return file_format
+
+
+def disassemble_file(input_filename: str, output_filename: str, file_format: str | None = None, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, little_endian: bool = False) -> dict[int, int]:
+    with open(input_filename, "rb") as f:
+        data = f.read()
+
+    memory, source = disassemble_image(
+        file_format or get_input_format(input_filename), data, depth, little_endian)
+    if output_filename == "-":
+        sys.stdout.write(source)
+    else:
+        with open(output_filename, "w", encoding="ascii") as f:
+            f.write(source)
+    return memory
+
+
+# runs in the batch worker processes, see assemble_file_job
+def disassemble_file_job(input_filename: str, output_filename: str, file_format: str | None = None, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, little_endian: bool = False) -> tuple[dict[int, int] | None, str | None, str | None]:
+    try:
+        return disassemble_file(input_filename, output_filename, file_format, depth, little_endian), None, None
+    except Exception as e:
+        return None, str(e), traceback.format_exc()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='ELEC374 MiniSRC Disassembler',
+        usage='python SRC_ASM.py disassemble <input path> [<input path> ...] -o <output path|-> -t [mem|mif|bin|hex|vhex] -d <memory depth> [-e big|little]',
+        description='Turns mem, mif, intel hex and binary memory images back into assembly that assembles to the same memory',
+        epilog='Contact asmhelp@davlaf.com if you have questions or to report bugs, or raise a github Issue')
+
+    parser.add_argument('filenames', nargs='+')  # input filenames or globs
+    parser.add_argument('-o', '--output')      # output filename, - for stdout
+    parser.add_argument('-v', '--verbose',
+                        action='store_true')  # on/off flag
+    parser.add_argument('-t', '--type', choices=input_formats)  # from the extension by default
+    parser.add_argument('-j', '--jobs', type=int)  # worker processes for batches
+    parser.add_argument('-d', '--depth', type=int,
+                        default=SRC_ASM.DEFAULT_MEMORY_DEPTH)  # words of memory
+    parser.add_argument('-e', '--endian', default="big",
+                        choices=["big", "little"])  # byte order of bin input
+    args = parser.parse_args(argv)
+    if args.depth < 1:
+        parser.error("--depth must be positive")
+
+    input_filenames = SRC_ASM.expand_input_filenames(args.filenames)
+    if len(input_filenames) == 0:
+        parser.error("no input files matched")
+
+    if args.output is None:
+        # .dis.s so a student's own program.s next to program.mem is kept
+        output_filenames = [SRC_ASM.get_output_filename(input_filename, "dis.s")
+                            for input_filename in input_filenames]
+    else:
+        if len(input_filenames) > 1:
+            parser.error("-o/--output can only be used with a single input file")
+        output_filenames = [args.output]
+
+    jobs = [(input_filename, output_filename, args.type, args.depth, args.endian == "little")
+            for input_filename, output_filename in zip(input_filenames, output_filenames)]
+    results = SRC_ASM.run_batch(disassemble_file_job, jobs, args.jobs)
+
+    failures = 0
+    for (input_filename, output_filename, *_), (memory, error, error_traceback) in zip(jobs, results):
+        if memory is None:
+            failures += 1
+            if args.verbose:
+                print(error_traceback)
+            elif len(jobs) > 1:
+                print(f"Error when disassembling {input_filename}: {error}")
+            else:
+                print(f"Error when disassembling: {error}")
+            continue
+
+        if output_filename != "-":
+            print(f"Successfully disassembled {input_filename} ({
+                  len(memory)} words) to {output_filename}")
+
+    if len(jobs) > 1:
+        print(f"Disassembled {len(jobs) - failures} of {len(jobs)} files")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+from array import array
+from typing import Callable
+
+import SRC_ASM
+
+
+class SimulationError(Exception):
+    pass
+
+
+WORD_MASK = 0xFFFFFFFF
+# jal writes the return address here, the lab programs return with jr R12
+DEFAULT_LINK_REGISTER = 12
+DEFAULT_MAX_STEPS = 1_000_000
+
+
+def to_signed(value: int) -> int:
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def sign_extend_constant(constant: int) -> int:
+    return constant - 0x80000 if constant & 0x40000 else constant
+
+
+# when each branch is taken, given the value of its ra. they are told apart
+# by the c2 values the assembler encodes (SRC_ASM.branch_c2_values)
+branch_conditions: dict[str, Callable[[int], bool]] = {
+    "brzr": lambda value: value == 0,
+    "brnz": lambda value: value != 0,
+    "brpl": lambda value: not value & 0x80000000,
+    "brmi": lambda value: bool(value & 0x80000000),
+}
+
+
+class Simulator:
+    """Runs a Mini SRC memory image, every word is decoded once up front"""
+
+    def __init__(self, memory: dict[int, int], depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, input_port: int = 0, link_register: int = DEFAULT_LINK_REGISTER):
+        self.depth = depth
+        self.memory = array(SRC_ASM.WORD_TYPECODE, bytes(4 * depth))
+        for address, word in memory.items():
+            self.memory[address] = word & WORD_MASK
+
+        self.registers = [0] * 16
+        self.hi = 0
+        self.lo = 0
+        self.pc = 0
+        self.input_port = input_port & WORD_MASK
+        self.outputs: list[int] = []
+        self.link_register = link_register
+        self.halted = False
+        self.steps = 0
+
+        # decoded fields of every word in memory, updated when st overwrites one
+        self.opcodes = array("B", bytes(depth))
+        self.ra = array("B", bytes(depth))
+        self.rb = array("B", bytes(depth))
+        self.rc = array("B", bytes(depth))
+        self.constants = array("i", bytes(4 * depth))
+        for address in range(depth):
+            self.decode(address)
+
+        # opcode -> handler, the branches share one opcode and use rb as c2
+        self.handlers = [self.execute_invalid] * 32
+        for name, opcode in SRC_ASM.opcodes.items():
+            if name in SRC_ASM.branch_c2_values:
+                self.handlers[opcode] = self.execute_branch
+            else:
+                self.handlers[opcode] = getattr(self, f"execute_{name}")
+        self.branch_conditions = {c2: branch_conditions[name]
+                                  for name, c2 in SRC_ASM.branch_c2_values.items()}
+
+    def decode(self, address: int):
+        word = self.memory[address]
+        self.opcodes[address] = word >> 27
+        self.ra[address] = (word >> 23) & 0xF
+        self.rb[address] = (word >> 19) & 0xF
+        self.rc[address] = (word >> 15) & 0xF
+        self.constants[address] = sign_extend_constant(word & 0x7FFFF)
+
+    def run(self, max_steps: int = DEFAULT_MAX_STEPS) -> bool:
+        # returns whether the program halted within max_steps
+        handlers = self.handlers
+        opcodes = self.opcodes
+        depth = self.depth
+        steps = 0
+        try:
+            while not self.halted and steps < max_steps:
+                address = self.pc
+                if not 0 <= address < depth:
+                    raise SimulationError(
+                        f"program counter {address:X} is outside of memory")
+                self.pc = address + 1
+                handlers[opcodes[address]](address)
+                steps += 1
+        finally:
+            self.steps += steps
+        return self.halted
+
+    # ld, ldi and st use 0 instead of the value of r0 as their base
+    def effective_address(self, address: int) -> int:
+        rb = self.rb[address]
+        base = self.registers[rb] if rb else 0
+        return (base + self.constants[address]) & WORD_MASK
+
+    def check_address(self, memory_address: int, address: int) -> int:
+        if memory_address >= self.depth:
+            raise SimulationError(
+                f"memory access to {memory_address:X} at {address:X} is outside of memory")
+        return memory_address
+
+    def set_ra(self, address: int, value: int):
+        self.registers[self.ra[address]] = value & WORD_MASK
+
+    def operands(self, address: int) -> tuple[int, int]:
+        return self.registers[self.rb[address]], self.registers[self.rc[address]]
+
+    def execute_invalid(self, address: int):
+        raise SimulationError(
+            f"invalid opcode {self.opcodes[address]:05b} at {address:X}")
+
+    def execute_ld(self, address: int):
+        memory_address = self.check_address(
+            self.effective_address(address), address)
+        self.set_ra(address, self.memory[memory_address])
+
+    def execute_ldi(self, address: int):
+        self.set_ra(address, self.effective_address(address))
+
+    def execute_st(self, address: int):
+        memory_address = self.check_address(
+            self.effective_address(address), address)
+        self.memory[memory_address] = self.registers[self.ra[address]]
+        self.decode(memory_address)
+
+    def execute_add(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, b + c)
+
+    def execute_sub(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, b - c)
+
+    def execute_and(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, b & c)
+
+    def execute_or(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, b | c)
+
+    def execute_ror(self, address: int):
+        b, c = self.operands(address)
+        c %= 32
+        self.set_ra(address, (b >> c) | (b << (32 - c)))
+
+    def execute_rol(self, address: int):
+        b, c = self.operands(address)
+        c %= 32
+        self.set_ra(address, (b << c) | (b >> (32 - c)))
+
+    def execute_shr(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, b >> c if c < 32 else 0)
+
+    def execute_shra(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, to_signed(b) >> min(c, 31))
+
+    def execute_shl(self, address: int):
+        b, c = self.operands(address)
+        self.set_ra(address, b << c if c < 32 else 0)
+
+    def execute_addi(self, address: int):
+        self.set_ra(address, self.registers[self.rb[address]] + self.constants[address])
+
+    def execute_andi(self, address: int):
+        self.set_ra(address, self.registers[self.rb[address]] & self.constants[address])
+
+    def execute_ori(self, address: int):
+        self.set_ra(address, self.registers[self.rb[address]] | self.constants[address])
+
+    def execute_mul(self, address: int):
+        product = to_signed(self.registers[self.ra[address]]) * \
+            to_signed(self.registers[self.rb[address]])
+        self.lo = product & WORD_MASK
+        self.hi = (product >> 32) & WORD_MASK
+
+    def execute_div(self, address: int):
+        dividend = to_signed(self.registers[self.ra[address]])
+        divisor = to_signed(self.registers[self.rb[address]])
+        if divisor == 0:
+            raise SimulationError(f"division by zero at {address:X}")
+        # rounds towards zero like verilog
+        quotient = abs(dividend) // abs(divisor)
+        if (dividend < 0) != (divisor < 0):
+            quotient = -quotient
+        self.lo = quotient & WORD_MASK
+        self.hi = (dividend - quotient * divisor) & WORD_MASK
+
+    def execute_neg(self, address: int):
+        self.set_ra(address, -self.registers[self.rb[address]])
+
+    def execute_not(self, address: int):
+        self.set_ra(address, ~self.registers[self.rb[address]])
+
+    def execute_branch(self, address: int):
+        condition = self.branch_conditions.get(self.rb[address])
+        if condition is None:
+            raise SimulationError(
+                f"invalid branch condition {self.rb[address]:04b} at {address:X}")
+        if condition(self.registers[self.ra[address]]):
+            self.pc = address + 1 + self.constants[address]
+
+    def execute_jal(self, address: int):
+        target = self.registers[self.ra[address]]
+        self.registers[self.link_register] = address + 1
+        self.pc = target
+
+    def execute_jr(self, address: int):
+        self.pc = self.registers[self.ra[address]]
+
+    def execute_in(self, address: int):
+        self.set_ra(address, self.input_port)
+
+    def execute_out(self, address: int):
+        self.outputs.append(self.registers[self.ra[address]])
+
+    def execute_mfhi(self, address: int):
+        self.set_ra(address, self.hi)
+
+    def execute_mflo(self, address: int):
+        self.set_ra(address, self.lo)
+
+    def execute_nop(self, address: int):
+        pass
+
+    def execute_halt(self, address: int):
+        self.halted = True
+        self.pc = address
+
+    def state(self) -> dict:
+        return {
+            "registers": {f"r{number}": value for number, value in enumerate(self.registers)},
+            "hi": self.hi,
+            "lo": self.lo,
+            "pc": self.pc,
+            "steps": self.steps,
+            "halted": self.halted,
+            "outputs": self.outputs,
+        }
+
+
+def simulate(code: str, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, max_steps: int = DEFAULT_MAX_STEPS, input_port: int = 0, link_register: int = DEFAULT_LINK_REGISTER) -> Simulator:
+    encoded_instructions = SRC_ASM.assemble(code, depth)[3]
+    memory = SRC_ASM.build_memory(encoded_instructions, depth)
+    simulator = Simulator(memory, depth, input_port, link_register)
+    simulator.run(max_steps)
+    return simulator
+
+
+def format_state(simulator: Simulator) -> str:
+    lines = [f"{'halted' if simulator.halted else 'stopped'} at pc {simulator.pc:X} after {simulator.steps} steps"]
+    for number in range(0, 16, 4):
+        lines.append("  ".join(f"R{register:<2} {simulator.registers[register]:08X}"
+                               for register in range(number, number + 4)))
+    lines.append(f"HI  {simulator.hi:08X}  LO  {simulator.lo:08X}")
+    if simulator.outputs:
+        lines.append(
+            f"out {' '.join(f'{value:X}' for value in simulator.outputs)}")
+    return "\n".join(lines)
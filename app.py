@@ -1,8 +1,741 @@
-from flask import Flask, render_template, request
+import bisect
+import gzip
+import hashlib
+import math
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Iterator
+
+from flask import Flask, Response, g, has_app_context, render_template, request
+from werkzeug.exceptions import RequestEntityTooLarge
 import SRC_ASM
+import SRC_DIS
+import SRC_SIM
 
 
 app = Flask(__name__)
+app.config['ASSEMBLE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('ASSEMBLE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+app.config['INCREMENTAL_MAX_SESSIONS'] = int(
+    os.environ.get('INCREMENTAL_MAX_SESSIONS', 256))
+app.config['INCREMENTAL_MAX_BYTES'] = int(
+    os.environ.get('INCREMENTAL_MAX_BYTES', 64 * 1024 * 1024))
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 500))
+# larger requests get a 413 before their body is read. form fields are held in
+# memory, so they get the same limit instead of flask's own
+app.config['MAX_CONTENT_LENGTH'] = int(
+    os.environ.get('MAX_CONTENT_LENGTH', 4 * 1024 * 1024))
+app.config['MAX_FORM_MEMORY_SIZE'] = app.config['MAX_CONTENT_LENGTH']
+# programs with more lines get a 413 before they are assembled
+app.config['MAX_SOURCE_LINES'] = int(
+    os.environ.get('MAX_SOURCE_LINES', 100_000))
+app.config['MAX_MEMORY_DEPTH'] = int(
+    os.environ.get('MAX_MEMORY_DEPTH', 64 * 1024))
+app.config['SIMULATE_MAX_STEPS'] = int(
+    os.environ.get('SIMULATE_MAX_STEPS', SRC_SIM.DEFAULT_MAX_STEPS))
+# processes that assemble, simulate and disassemble for requests, 0 runs the
+# work in the request thread instead
+app.config['WORKERS'] = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+# pieces of work running or waiting for a worker before requests get a 503
+app.config['WORK_QUEUE_DEPTH'] = int(
+    os.environ.get('WORK_QUEUE_DEPTH', 4 * max(app.config['WORKERS'], 1)))
+app.config['WORK_TIMEOUT'] = float(os.environ.get('WORK_TIMEOUT', 10))
+# seconds a worker process has to import the app and say it is ready
+app.config['WORKER_START_TIMEOUT'] = float(
+    os.environ.get('WORKER_START_TIMEOUT', 60))
+app.config['METRICS_ENABLED'] = os.environ.get(
+    'METRICS_ENABLED', '1').lower() not in ['0', 'false', 'off']
+# responses smaller than this are sent uncompressed
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+# seconds browsers and proxies may keep a sample's output before checking its ETag
+app.config['SAMPLES_MAX_AGE'] = int(os.environ.get('SAMPLES_MAX_AGE', 24 * 60 * 60))
+# the directory programs can include files from
+app.config['ASSEMBLY_LIBRARY'] = os.environ.get(
+    'ASSEMBLY_LIBRARY', os.path.join(app.root_path, 'static'))
+
+
+# results are keyed on the assembler source and the library too, so a redeploy
+# with a changed assembler or library never serves (or 304s) old output
+def get_assembler_version(library: str) -> str:
+    digest = hashlib.sha256()
+    with open(SRC_ASM.__file__, 'rb') as f:
+        digest.update(f.read())
+    for directory, directory_names, filenames in os.walk(library):
+        directory_names.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            digest.update(os.path.relpath(path, library).encode('utf8', errors='surrogateescape') + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+ASSEMBLER_VERSION = get_assembler_version(app.config['ASSEMBLY_LIBRARY'])
+
+# shared by every request thread, warnings come back with each result instead
+# of being printed to the server log
+lab_assembler = SRC_ASM.Assembler(
+    'lab', app.config['ASSEMBLY_LIBRARY'], app.config['MAX_SOURCE_LINES'])
+
+
+# about how many bytes a response takes, strings and bytes by their length and
+# everything else (numbers and the containers themselves) as 8 bytes each
+def estimate_size(value) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return 8 + sum(len(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, list):
+        return 8 + sum(map(estimate_size, value))
+    return 8
+
+
+class AssemblyCache:
+    """LRU cache of /assemble responses, bounded by the total size of the cached output"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[dict, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, response: dict):
+        size = len(key) + estimate_size(response)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (response, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+
+assembly_cache = AssemblyCache(app.config['ASSEMBLE_CACHE_MAX_BYTES'])
+
+
+class AssemblerSessions:
+    """Incremental assemblers for editor sessions, bounded by count and by their estimated size, least recently used ones are dropped first"""
+
+    def __init__(self, max_sessions: int, max_bytes: int, token_prefix: str = ''):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.token_prefix = token_prefix
+        self.current_bytes = 0
+        self._sessions: OrderedDict[str, tuple[SRC_ASM.IncrementalAssembler, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    # returns the session's assembler, starting a new session if the token is unknown
+    def get(self, token: str) -> tuple[str, SRC_ASM.IncrementalAssembler]:
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is not None:
+                self._sessions.move_to_end(token)
+                return token, entry[0]
+
+            token = self.token_prefix + secrets.token_urlsafe(16)
+            assembler = SRC_ASM.IncrementalAssembler()
+            self._sessions[token] = (assembler, 0)
+            self._evict()
+            return token, assembler
+
+    # sessions only grow when they assemble, so their size is taken again afterwards.
+    # a session too large to keep on its own is dropped and starts over next time
+    def update(self, token: str):
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is None:
+                return
+            assembler, size = entry
+            self.current_bytes += assembler.size - size
+            self._sessions[token] = (assembler, assembler.size)
+            if assembler.size > self.max_bytes:
+                self.current_bytes -= self._sessions.pop(token)[1]
+            self._evict()
+
+    def _evict(self):
+        while len(self._sessions) > self.max_sessions or self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._sessions.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+assembler_sessions = AssemblerSessions(
+    app.config['INCREMENTAL_MAX_SESSIONS'], app.config['INCREMENTAL_MAX_BYTES'])
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class SourceTooLarge(Exception):
+    pass
+
+
+# counting lines is much cheaper than hashing or assembling, so a program that
+# is too long is turned away before anything else is done with it
+def check_source_size(code: str) -> str:
+    lines = code.count('\n') + (not code.endswith('\n'))
+    if lines > app.config['MAX_SOURCE_LINES']:
+        raise SourceTooLarge(
+            f"the program has {lines} lines, the maximum is {app.config['MAX_SOURCE_LINES']}")
+    return code
+
+
+# runs in the worker processes, the phase timings are sent back with the result
+# so they are counted by the process serving /metrics
+def run_in_worker(function: Callable, argument_lists: list[tuple]) -> tuple[list, list[tuple[str, float]]]:
+    timings: list[tuple[str, float]] = []
+    SRC_ASM.set_phase_timer(lambda phase, seconds: timings.append((phase, seconds)))
+    try:
+        return [function(*arguments) for arguments in argument_lists], timings
+    finally:
+        SRC_ASM.set_phase_timer(None)
+
+
+# the loop of a worker process. it keeps its own editor sessions, with tokens
+# that start with its index so their requests are sent back to it
+def serve_worker(connection, index: int, workers: int):
+    global assembler_sessions
+    assembler_sessions = AssemblerSessions(
+        math.ceil(app.config['INCREMENTAL_MAX_SESSIONS'] / workers),
+        app.config['INCREMENTAL_MAX_BYTES'] // workers, f'{index}-')
+    connection.send(None)
+    while True:
+        try:
+            function, argument_lists = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = run_in_worker(function, argument_lists), None
+        except Exception as e:
+            result = None, e
+        connection.send((result, len(assembler_sessions), assembler_sessions.current_bytes))
+
+
+class Worker:
+    """A worker process that runs one piece of work at a time, started again when it dies or is stopped"""
+
+    def __init__(self, index: int, workers: int):
+        self.index = index
+        self.workers = workers
+        self.load = 0  # pieces of work running on it or waiting for it
+        self.sessions = 0
+        self.session_bytes = 0
+        self.lock = threading.Lock()
+        self._process: multiprocessing.Process | None = None
+        self._connection = None
+
+    # starting takes as long as importing the app, which isn't counted
+    # against the timeout of the work waiting for it but has its own
+    def start(self, timeout: float):
+        if self._process is not None and self._process.is_alive():
+            return
+        self.stop()
+        # forking a threaded server process isn't safe, workers are
+        # started from a clean process instead
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        connection, child_connection = context.Pipe()
+        process = context.Process(
+            target=serve_worker, args=(child_connection, self.index, self.workers), daemon=True)
+        try:
+            process.start()
+        finally:
+            child_connection.close()
+        self._process, self._connection = process, connection
+        # sent once it is ready
+        if not connection.poll(timeout):
+            self.stop()
+            raise ServerBusy("the server is starting its workers, try again in a moment")
+        connection.recv()
+
+    def send(self, function: Callable, argument_lists: list[tuple]):
+        self._connection.send((function, argument_lists))
+
+    # the result, or the exception the work raised
+    def receive(self, timeout: float) -> tuple[tuple[list, list[tuple[str, float]]] | None, Exception | None]:
+        if not self._connection.poll(timeout):
+            raise TimeoutError()
+        result, self.sessions, self.session_bytes = self._connection.recv()
+        return result
+
+    # the work it was doing is abandoned, and so are its sessions
+    def stop(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._connection.close()
+        self._process = None
+        self._connection = None
+        self.sessions = 0
+        self.session_bytes = 0
+
+
+class WorkerPool:
+    """Worker processes for the CPU heavy part of requests, work past the queue depth is turned away instead of waiting"""
+
+    def __init__(self, workers: int, queue_depth: int, timeout: float, start_timeout: float):
+        self.workers = workers
+        self.queue_depth = max(queue_depth, workers)
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._workers = [Worker(index, workers) for index in range(workers)]
+        self._lock = threading.Lock()
+
+    # picks the least loaded workers, or the one a session lives on
+    def _reserve(self, count: int, worker_index: int | None = None) -> list[Worker]:
+        with self._lock:
+            if self.queued + count > self.queue_depth:
+                self.rejected += 1
+                raise ServerBusy("the server is busy, try again in a moment")
+            self.queued += count
+            if worker_index is not None:
+                workers = [self._workers[worker_index]]
+            else:
+                workers = sorted(self._workers, key=lambda worker: worker.load)[:count]
+            for worker in workers:
+                worker.load += 1
+        # batches lock their workers in order, so two of them never wait on each other
+        return sorted(workers, key=lambda worker: worker.index)
+
+    def _release(self, workers: list[Worker]):
+        with self._lock:
+            self.queued -= len(workers)
+            for worker in workers:
+                worker.load -= 1
+
+    # runs one chunk of argument lists on each worker. a worker that takes too
+    # long is stopped, so a request that times out gives its worker back
+    def _run(self, workers: list[Worker], function: Callable, chunks: list[list[tuple]], timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        locked: list[Worker] = []
+        running: list[Worker] = []
+        results = []
+        try:
+            for worker in workers:
+                if not worker.lock.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                    with self._lock:
+                        self.timeouts += 1
+                    raise TimeoutError()
+                locked.append(worker)
+            try:
+                for worker in workers:
+                    worker.start(self.start_timeout)
+                # waiting for a busy worker counts against the timeout, starting one doesn't
+                deadline = time.monotonic() + timeout
+                for worker, chunk in zip(workers, chunks):
+                    running.append(worker)
+                    worker.send(function, chunk)
+                for worker in workers:
+                    result, error = worker.receive(max(deadline - time.monotonic(), 0))
+                    running.remove(worker)
+                    if error is not None:
+                        raise error
+                    chunk_results, timings = result
+                    if SRC_ASM.phase_timer is not None:
+                        for phase, seconds in timings:
+                            SRC_ASM.phase_timer(phase, seconds)
+                    results.extend(chunk_results)
+            except TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                raise
+            except (EOFError, OSError):
+                # a worker died (out of memory for example), it is started
+                # again for the next piece of work
+                raise ServerBusy("the server is restarting its workers, try again in a moment")
+        finally:
+            for worker in running:
+                worker.stop()
+            for worker in locked:
+                worker.lock.release()
+            self._release(workers)
+        return results
+
+    # runs function once per argument list and returns the results in order
+    def map(self, function: Callable, argument_lists: list[tuple]) -> list:
+        if self.workers == 0 or not argument_lists:
+            return [function(*arguments) for arguments in argument_lists]
+
+        # large batches are split in one chunk per worker so they take at most
+        # that many slots
+        chunk_count = min(len(argument_lists), self.workers)
+        chunk_size = math.ceil(len(argument_lists) / chunk_count)
+        chunks = [argument_lists[i:i + chunk_size]
+                  for i in range(0, len(argument_lists), chunk_size)]
+        # the timeout is per piece of work, and the chunks run side by side
+        return self._run(self._reserve(len(chunks)), function, chunks, self.timeout * chunk_size)
+
+    def run(self, function: Callable, *arguments):
+        return self.map(function, [arguments])[0]
+
+    # runs function(session, *arguments) on the worker that holds the session,
+    # or on the least loaded one for a new session
+    def run_session(self, function: Callable, session: str, *arguments):
+        if self.workers == 0:
+            return function(session, *arguments)
+        index = session.partition('-')[0]
+        worker_index = int(index) if index.isdigit() and int(index) < self.workers else None
+        workers = self._reserve(1, worker_index)
+        return self._run(workers, function, [[(session, *arguments)]], self.timeout)[0]
+
+    # the sessions kept by the workers and their estimated size
+    def session_totals(self) -> tuple[int, int]:
+        if self.workers == 0:
+            return len(assembler_sessions), assembler_sessions.current_bytes
+        return (sum(worker.sessions for worker in self._workers),
+                sum(worker.session_bytes for worker in self._workers))
+
+
+worker_pool = WorkerPool(app.config['WORKERS'], app.config['WORK_QUEUE_DEPTH'],
+                         app.config['WORK_TIMEOUT'], app.config['WORKER_START_TIMEOUT'])
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...]) -> str:
+    return ','.join(f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values))
+
+
+class Counter:
+    """Prometheus counter with labels"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: tuple[str, ...], amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}\n'
+        yield f'# TYPE {self.name} counter\n'
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{{{format_labels(self.label_names, label_values)}}} {value}\n'
+
+
+class Histogram:
+    """Prometheus histogram with labels, the bucket counts are made cumulative when exposed"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket (with +Inf last), sum]
+        self._series: dict[tuple[str, ...], list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple[str, ...], value: float):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[bucket] += 1
+            series[-1] += value
+
+    def expose(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}\n'
+        yield f'# TYPE {self.name} histogram\n'
+        with self._lock:
+            all_series = [(label_values, list(series)) for label_values, series in self._series.items()]
+        for label_values, series in all_series:
+            labels = format_labels(self.label_names, label_values)
+            separator = ',' if labels else ''
+            count = 0
+            for upper_bound, bucket_count in zip([*map(str, self.buckets), '+Inf'], series):
+                count += bucket_count
+                yield f'{self.name}_bucket{{{labels}{separator}le="{upper_bound}"}} {count}\n'
+            yield f'{self.name}_sum{{{labels}}} {series[-1]}\n'
+            yield f'{self.name}_count{{{labels}}} {count}\n'
+
+
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+phase_duration = Histogram(
+    'src_asm_phase_duration_seconds', 'Time spent in each assembler phase',
+    ('phase', 'format'), DURATION_BUCKETS)
+request_duration = Histogram(
+    'src_asm_request_duration_seconds', 'Time taken to handle a request',
+    ('endpoint', 'format'), DURATION_BUCKETS)
+request_size = Histogram(
+    'src_asm_request_size_bytes', 'Size of request bodies',
+    ('endpoint',), SIZE_BUCKETS)
+requests_total = Counter(
+    'src_asm_requests_total', 'Requests handled', ('endpoint', 'status'))
+errors_total = Counter(
+    'src_asm_errors_total', 'Requests answered with an error, including assembly errors',
+    ('endpoint', 'format'))
+
+
+# runs in whichever thread assembles. outside of a request (the samples made at
+# startup) phases aren't counted
+def record_phase(phase: str, seconds: float):
+    if not has_app_context():
+        return
+    phase_duration.observe((phase, g.get('format_type', '')), seconds)
+
+
+# routes call this once the format is known to be valid, so the label can't
+# take arbitrary values
+def set_metrics_format(format_type: str):
+    g.format_type = format_type
+
+
+# routes that report errors with a 200 (like /assemble, so the page can show
+# them) call this so they still count as errors
+def set_metrics_error():
+    g.request_failed = True
+
+
+def get_metrics_endpoint() -> str:
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+def record_request(response: Response) -> Response:
+    endpoint = get_metrics_endpoint()
+    format_type = g.get('format_type', '')
+    request_duration.observe(
+        (endpoint, format_type), time.perf_counter() - g.request_start)
+    request_size.observe((endpoint,), request.content_length or 0)
+    requests_total.inc((endpoint, str(response.status_code)))
+    if response.status_code >= 400 or g.get('request_failed', False):
+        errors_total.inc((endpoint, format_type))
+    return response
+
+
+if app.config['METRICS_ENABLED']:
+    SRC_ASM.set_phase_timer(record_phase)
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+
+COMPRESSED_MIMETYPES = ['application/json', 'text/plain', 'text/html', 'application/octet-stream']
+
+
+# gzip or deflate for the clients that accept them. the output is mostly runs
+# of the same lines, so it shrinks to a small part of its size. the ETag
+# becomes weak since the bytes sent are different
+@app.after_request
+def compress_response(response: Response) -> Response:
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or response.mimetype not in COMPRESSED_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    data = response.get_data()
+    if encoding is None or len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    level = app.config['COMPRESS_LEVEL']
+    if encoding == 'gzip':
+        response.set_data(gzip.compress(data, level, mtime=0))
+    else:
+        response.set_data(zlib.compress(data, level))
+    response.headers['Content-Encoding'] = encoding
+    etag, is_weak = response.get_etag()
+    if etag is not None and not is_weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def assembly_key(code: str, format_type: str, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False, compact: bool = False) -> str:
+    digest = hashlib.sha256()
+    for part in (ASSEMBLER_VERSION, format_type, str(depth), str(sparse), str(little_endian), str(compact), code):
+        digest.update(part.encode('utf8', errors='surrogatepass'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_output_options(values) -> tuple[int, bool, bool]:
+    try:
+        depth = int(values.get('depth', SRC_ASM.DEFAULT_MEMORY_DEPTH))
+    except ValueError:
+        raise ValueError("memory depth must be a number")
+    if not 0 < depth <= app.config['MAX_MEMORY_DEPTH']:
+        raise ValueError(
+            f"memory depth must be between 1 and {app.config['MAX_MEMORY_DEPTH']}")
+
+    sparse = str(values.get('sparse', '')).lower() in ['1', 'true', 'on']
+    little_endian = values.get('endian', 'big') == 'little'
+    return depth, sparse, little_endian
+
+
+# mem and mif output can be sent as only its used words, which the page writes
+# out as text itself (see SRC_ASM.sparse_output)
+SPARSE_OUTPUT_FORMATS = ['mem', 'mif']
+
+
+def get_compact(values, format_type: str) -> bool:
+    return format_type in SPARSE_OUTPUT_FORMATS and str(values.get('compact', '')).lower() in ['1', 'true', 'on']
+
+
+# image formats give bytes as their output, the text formats a string
+def get_diagnostics(code: str, depth: int) -> list[dict[str, str | int]]:
+    return [diagnostic._asdict() for diagnostic in lab_assembler.check(code, depth)]
+
+
+# when assembling stops at an error (or gave warnings), the program is checked
+# again to report every problem with its line, so the common case of a clean
+# program costs nothing extra
+def assemble_response(code: str, format_type: str, assembler: SRC_ASM.IncrementalAssembler | None = None, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH, sparse: bool = False, little_endian: bool = False, compact: bool = False) -> dict:
+    try:
+        if compact:
+            result = lab_assembler.assemble(code, depth, assembler)
+            response = {'sparse_output': SRC_ASM.timed_phase(
+                'format', SRC_ASM.sparse_output, result.program, sparse)}
+        else:
+            result = lab_assembler.assemble_to(
+                format_type, code, depth, sparse, little_endian, assembler)
+            response = {'output': result.output}
+    except Exception as e:
+        return {"error": str(e), "diagnostics": get_diagnostics(code, depth)}
+
+    if result.warnings:
+        response['warnings'] = result.warnings
+        response['diagnostics'] = get_diagnostics(code, depth)
+    return response
+
+
+# runs where the session lives, an unknown token starts a new session
+def assemble_session_response(session: str, code: str, format_type: str, depth: int, sparse: bool, little_endian: bool, compact: bool) -> dict:
+    session, assembler = assembler_sessions.get(session)
+    try:
+        response = assemble_response(
+            code, format_type, assembler, depth, sparse, little_endian, compact)
+    finally:
+        assembler_sessions.update(session)
+    return {**response, 'session': session}
+
+
+def check_response(code: str, depth: int) -> dict:
+    diagnostics = get_diagnostics(code, depth)
+    return {'ok': not any(diagnostic['severity'] == 'error' for diagnostic in diagnostics),
+            'diagnostics': diagnostics}
+
+
+def simulate_response(code: str, depth: int, max_steps: int, input_port: int) -> dict:
+    with lab_assembler.session() as warnings:
+        try:
+            state = SRC_SIM.simulate(code, depth, max_steps, input_port).state()
+        except Exception as e:
+            return {"error": str(e)}
+    if warnings:
+        return {**state, 'warnings': warnings}
+    return state
+
+
+def disassemble_response(format_type: str, data: bytes, depth: int, little_endian: bool) -> dict[str, str | int]:
+    try:
+        memory, source = SRC_DIS.disassemble_image(
+            format_type, data, depth, little_endian)
+    except Exception as e:
+        return {"error": str(e)}
+    return {'output': source, 'words': len(memory)}
+
+
+class SampleOutputs:
+    """/assemble responses for the sample programs in static, made at startup in every format with the default options"""
+
+    def __init__(self, directory: str):
+        self.hits = 0
+        # assembly key -> response, and (name, format) -> (assembly key, response)
+        self._by_key: dict[str, dict] = {}
+        self._by_name: dict[tuple[str, str], tuple[str, dict]] = {}
+        for filename in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(filename)
+            if extension != '.s':
+                continue
+            with open(os.path.join(directory, filename), encoding='utf8', newline='') as f:
+                code = f.read()
+            for format_type in SRC_ASM.output_formats:
+                for compact in [False, True] if format_type in SPARSE_OUTPUT_FORMATS else [False]:
+                    key = assembly_key(code, format_type, compact=compact)
+                    response = assemble_response(code, format_type, compact=compact)
+                    self._by_key[key] = response
+                    # the page sends textarea text, which always has \n line endings
+                    self._by_key[assembly_key(code.replace('\r\n', '\n'), format_type, compact=compact)] = response
+                    if not compact:
+                        self._by_name[(name, format_type)] = (key, response)
+
+    # the response for a request with exactly a sample's source and options
+    def get(self, key: str) -> dict | None:
+        response = self._by_key.get(key)
+        if response is not None:
+            self.hits += 1
+        return response
+
+    def get_by_name(self, name: str, format_type: str) -> tuple[str, dict] | None:
+        return self._by_name.get((name, format_type))
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+
+sample_outputs = SampleOutputs(os.path.join(app.root_path, 'static'))
+
+
+def image_download(image: bytes, format_type: str, headers: dict[str, str]) -> Response:
+    headers = {**headers, 'Content-Disposition': f'attachment; filename=output.{format_type}'}
+    return Response(image, mimetype='application/octet-stream', headers=headers)
+
+
+@app.errorhandler(ServerBusy)
+def server_busy(e: ServerBusy):
+    return {"error": str(e)}, 503, {'Retry-After': '1'}
+
+@app.errorhandler(TimeoutError)
+def work_timeout(e: TimeoutError):
+    return {"error": f"took longer than the limit of {app.config['WORK_TIMEOUT']} seconds"}, 504
+
+@app.errorhandler(SourceTooLarge)
+def source_too_large(e: SourceTooLarge):
+    return {"error": str(e)}, 413
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e: RequestEntityTooLarge):
+    return {"error": f"the request is larger than the limit of {app.config['MAX_CONTENT_LENGTH']} bytes"}, 413
 
 @app.route('/')
 def index():
@@ -10,18 +743,243 @@ def index():
 
 @app.route('/assemble', methods=['POST'])
 def assemble_code():
-    code = request.form['code']
+    code = check_source_size(request.form['code'])
     format_type = request.form['format']
+    # editors that send a session token (empty to start one) are assembled
+    # incrementally against their previous revision
+    session_token = request.form.get('session')
 
-    if format_type not in ['mem', 'mif']:
+    if format_type not in SRC_ASM.output_formats:
+        set_metrics_error()
         return {"error": "invalid format"}
-    
+    set_metrics_format(format_type)
     try:
-        _, output_assembly = SRC_ASM.assembly_to_file(format_type, code)
-    except Exception as e:
+        depth, sparse, little_endian = get_output_options(request.form)
+    except ValueError as e:
+        set_metrics_error()
         return {"error": str(e)}
+    compact = get_compact(request.form, format_type)
+
+    key = assembly_key(code, format_type, depth, sparse, little_endian, compact)
+    # the key is derived from the request itself, so a client holding the
+    # matching tag already has this exact response. compressed responses
+    # have it as a weak tag
+    if request.if_none_match.contains_weak(key):
+        return '', 304, {'ETag': f'"{key}"'}
+
+    response = sample_outputs.get(key) or assembly_cache.get(key)
+    if response is None:
+        # incremental assemblers live in the worker processes, so a session is
+        # always assembled by the same one. it only re-encodes the lines that changed
+        if session_token is not None:
+            response = worker_pool.run_session(
+                assemble_session_response, session_token, code, format_type, depth, sparse, little_endian, compact)
+            session_token = response.pop('session')
+        else:
+            response = worker_pool.run(
+                assemble_response, code, format_type, None, depth, sparse, little_endian, compact)
+        assembly_cache.put(key, response)
+    if 'error' in response:
+        set_metrics_error()
+
+    if format_type in SRC_ASM.image_formats and 'output' in response:
+        headers = {'ETag': f'"{key}"'}
+        if session_token:
+            headers['X-Assembly-Session'] = session_token
+        return image_download(response['output'], format_type, headers)
+
+    if session_token:
+        response = {**response, 'session': session_token}
+    return response, 200, {'ETag': f'"{key}"'}
+
+@app.route('/assemble/download', methods=['POST'])
+def download_assembly():
+    code = check_source_size(request.form['code'])
+    format_type = request.form['format']
+
+    if format_type not in SRC_ASM.output_formats:
+        return {"error": "invalid format"}, 400
+    set_metrics_format(format_type)
+    try:
+        depth, sparse, little_endian = get_output_options(request.form)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    key = assembly_key(code, format_type, depth, sparse, little_endian)
+    response = sample_outputs.get(key) or assembly_cache.get(key)
+    if response is None:
+        response = worker_pool.run(
+            assemble_response, code, format_type, None, depth, sparse, little_endian)
+        assembly_cache.put(key, response)
+    if 'error' in response:
+        return response, 400
+
+    if format_type in SRC_ASM.image_formats:
+        return image_download(response['output'], format_type, {'ETag': f'"{key}"'})
+    headers = {'Content-Disposition': f'attachment; filename=output.{format_type}'}
+    return Response(response['output'], mimetype='text/plain', headers=headers)
+
+@app.route('/assemble/batch', methods=['POST'])
+def assemble_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return {"error": "expected a JSON object with format and files"}, 400
+
+    format_type = body.get('format', 'mem')
+    files = body.get('files')
+    # image formats are binary and can't be put in the JSON response
+    if format_type not in SRC_ASM.text_formats:
+        return {"error": "invalid format"}, 400
+    set_metrics_format(format_type)
+    if not isinstance(files, dict) or not all(isinstance(code, str) for code in files.values()):
+        return {"error": "files must map file names to source code"}, 400
+    if len(files) > app.config['BATCH_MAX_FILES']:
+        return {"error": f"too many files, the maximum is {app.config['BATCH_MAX_FILES']}"}, 400
+    for code in files.values():
+        check_source_size(code)
+    try:
+        depth, sparse, _ = get_output_options(body)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    results: dict[str, dict[str, str]] = {}
+    misses: list[tuple[str, str]] = []
+    for name, code in files.items():
+        key = assembly_key(code, format_type, depth, sparse)
+        if (response := sample_outputs.get(key) or assembly_cache.get(key)) is not None:
+            results[name] = response
+        else:
+            misses.append((name, key))
+
+    responses = worker_pool.map(
+        assemble_response,
+        [(files[name], format_type, None, depth, sparse)
+         for name, _ in misses])
+    for (name, key), response in zip(misses, responses):
+        assembly_cache.put(key, response)
+        results[name] = response
+
+    return {'results': {name: results[name] for name in files}}
+
+# the output of a sample program, assembled at startup. the URL's content only
+# changes when the app is redeployed, so it can be kept for a while
+@app.route('/samples/<name>.<format_type>')
+def sample_output(name: str, format_type: str):
+    sample = sample_outputs.get_by_name(name, format_type)
+    if sample is None:
+        return {"error": "unknown sample or format"}, 404
+    key, response = sample
+    set_metrics_format(format_type)
+    headers = {'ETag': f'"{key}"', 'Cache-Control': f"public, max-age={app.config['SAMPLES_MAX_AGE']}"}
+    if request.if_none_match.contains_weak(key):
+        return '', 304, headers
+    if 'error' in response:
+        return response, 500, headers
+    if format_type in SRC_ASM.image_formats:
+        return Response(response['output'], mimetype='application/octet-stream', headers=headers)
+    return Response(response['output'], mimetype='text/plain', headers=headers)
+
+# reports every error and warning without formatting any output
+@app.route('/check', methods=['POST'])
+def check_code():
+    code = check_source_size(request.form['code'])
+    try:
+        depth, _, _ = get_output_options(request.form)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    response = worker_pool.run(check_response, code, depth)
+    if not response['ok']:
+        set_metrics_error()
+    return response
+
+@app.route('/simulate', methods=['POST'])
+def simulate_code():
+    code = check_source_size(request.form['code'])
+    try:
+        depth, _, _ = get_output_options(request.form)
+        max_steps = int(request.form.get(
+            'max_steps', app.config['SIMULATE_MAX_STEPS']))
+        input_port = int(request.form.get('input', '0'), 0)
+    except ValueError as e:
+        set_metrics_error()
+        return {"error": str(e)}
+    max_steps = min(max(max_steps, 0), app.config['SIMULATE_MAX_STEPS'])
+
+    response = worker_pool.run(
+        simulate_response, code, depth, max_steps, input_port)
+    if 'error' in response:
+        set_metrics_error()
+    return response
+
+# takes the image as an uploaded file or as text in the data field
+@app.route('/disassemble', methods=['POST'])
+def disassemble_image():
+    upload = request.files.get('file')
+    format_type = request.form.get('format')
+    try:
+        if format_type is None and upload is not None and upload.filename:
+            format_type = SRC_DIS.get_input_format(upload.filename)
+        if format_type not in SRC_DIS.input_formats:
+            return {"error": "invalid format"}, 400
+        set_metrics_format(format_type)
+        depth, _, little_endian = get_output_options(request.form)
+    except (ValueError, SRC_DIS.DisassemblyError) as e:
+        return {"error": str(e)}, 400
+
+    if upload is not None:
+        data = upload.read()
+    else:
+        data = request.form.get('data', '').encode('ascii', errors='replace')
+
+    response = worker_pool.run(
+        disassemble_response, format_type, data, depth, little_endian)
+    if 'error' in response:
+        return response, 400
+    return response
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        return {"error": "metrics are disabled"}, 404
+
+    def expose() -> Iterator[str]:
+        for metric in (requests_total, errors_total, request_duration, request_size, phase_duration):
+            yield from metric.expose()
+        lookups = assembly_cache.hits + assembly_cache.misses
+        yield '# HELP src_asm_cache_hits_total Assembly cache hits\n'
+        yield '# TYPE src_asm_cache_hits_total counter\n'
+        yield f'src_asm_cache_hits_total {assembly_cache.hits}\n'
+        yield '# HELP src_asm_cache_misses_total Assembly cache misses\n'
+        yield '# TYPE src_asm_cache_misses_total counter\n'
+        yield f'src_asm_cache_misses_total {assembly_cache.misses}\n'
+        yield '# HELP src_asm_cache_hit_ratio Share of assembly cache lookups that hit\n'
+        yield '# TYPE src_asm_cache_hit_ratio gauge\n'
+        yield f'src_asm_cache_hit_ratio {assembly_cache.hits / lookups if lookups else 0}\n'
+        yield '# HELP src_asm_cache_bytes Size of the cached assembly output\n'
+        yield '# TYPE src_asm_cache_bytes gauge\n'
+        yield f'src_asm_cache_bytes {assembly_cache.current_bytes}\n'
+        yield '# HELP src_asm_sample_hits_total Assembly requests answered with a sample output made at startup\n'
+        yield '# TYPE src_asm_sample_hits_total counter\n'
+        yield f'src_asm_sample_hits_total {sample_outputs.hits}\n'
+        yield '# HELP src_asm_incremental_sessions Incremental assembler sessions kept\n'
+        yield '# TYPE src_asm_incremental_sessions gauge\n'
+        sessions, session_bytes = worker_pool.session_totals()
+        yield f'src_asm_incremental_sessions {sessions}\n'
+        yield '# HELP src_asm_incremental_bytes Estimated size of the incremental assembler sessions kept\n'
+        yield '# TYPE src_asm_incremental_bytes gauge\n'
+        yield f'src_asm_incremental_bytes {session_bytes}\n'
+        yield '# HELP src_asm_work_queued Pieces of work running or waiting for a worker process\n'
+        yield '# TYPE src_asm_work_queued gauge\n'
+        yield f'src_asm_work_queued {worker_pool.queued}\n'
+        yield '# HELP src_asm_work_rejected_total Requests turned away with a 503 because the work queue was full\n'
+        yield '# TYPE src_asm_work_rejected_total counter\n'
+        yield f'src_asm_work_rejected_total {worker_pool.rejected}\n'
+        yield '# HELP src_asm_work_timeouts_total Requests that gave up waiting for their work\n'
+        yield '# TYPE src_asm_work_timeouts_total counter\n'
+        yield f'src_asm_work_timeouts_total {worker_pool.timeouts}\n'
 
-    return {'output': output_assembly}
+    return Response(''.join(expose()), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,408 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import statistics
+from datetime import datetime, timezone
+from typing import Callable
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+
+import SRC_ASM  # noqa: E402
+
+
+# programs are generated from a seed so runs on different machines (or
+# before and after a change) time exactly the same code
+
+reg_reg_reg = SRC_ASM.reg_reg_reg
+reg_reg_const = SRC_ASM.reg_reg_const
+branches = SRC_ASM.reg_const
+reg_reg = SRC_ASM.reg_reg
+
+
+def random_register(rng: random.Random) -> str:
+    return f"R{rng.randrange(16)}"
+
+
+def random_constant(rng: random.Random) -> str:
+    value = rng.randrange(-256, 256)
+    return hex(value) if value >= 0 and rng.random() < 0.5 else str(value)
+
+
+def random_instruction(rng: random.Random, labels: list[str]) -> str:
+    kind = rng.random()
+    if kind < 0.3:
+        return f"{rng.choice(reg_reg_reg)} {random_register(rng)}, {random_register(rng)}, {random_register(rng)}"
+    if kind < 0.5:
+        return f"{rng.choice(reg_reg_const)} {random_register(rng)}, {random_register(rng)}, {random_constant(rng)}"
+    if kind < 0.7:
+        return f"{rng.choice(['ld', 'ldi'])} {random_register(rng)}, {random_constant(rng)}({random_register(rng)})"
+    if kind < 0.75:
+        return f"st {random_constant(rng)}({random_register(rng)}), {random_register(rng)}"
+    if kind < 0.85 and labels:
+        return f"{rng.choice(branches)} {random_register(rng)}, {rng.choice(labels)}"
+    if kind < 0.95:
+        return f"{rng.choice(reg_reg)} {random_register(rng)}, {random_register(rng)}"
+    return rng.choice(["nop", f"out {random_register(rng)}", f"in {random_register(rng)}", f"mflo {random_register(rng)}"])
+
+
+# every word of a 512 word memory holds an instruction
+def full_image_program(rng: random.Random, depth: int = SRC_ASM.DEFAULT_MEMORY_DEPTH) -> str:
+    labels = [f"block{i}" for i in range((depth + 31) // 32)]
+    lines = ["        org 0"]
+    for address in range(depth - 1):
+        label = f"block{address // 32}:" if address % 32 == 0 else ""
+        lines.append(f"{label:<8}{random_instruction(rng, labels)}")
+    lines.append("        halt")
+    return "\n".join(lines) + "\n"
+
+
+# a label on nearly every line and a branch to one in every other instruction
+def branch_heavy_program(rng: random.Random, instruction_count: int = 480) -> str:
+    line_labels = [f"label_{i}" if rng.random() < 0.9 else None for i in range(instruction_count)]
+    labels = [label for label in line_labels if label is not None]
+    lines = []
+    for i, label in enumerate(line_labels):
+        if i % 2:
+            instruction = f"{rng.choice(branches)} {random_register(rng)}, {rng.choice(labels)}"
+        else:
+            instruction = random_instruction(rng, labels)
+        lines.append(f"{label}: {instruction}" if label else f"    {instruction}")
+    lines.append("    halt")
+    return "\n".join(lines) + "\n"
+
+
+# lab style listings, every instruction commented and whole comment lines between
+def comment_heavy_program(rng: random.Random, instruction_count: int = 400) -> str:
+    lines = ["; generated comment heavy listing", "        ORG 0"]
+    for i in range(instruction_count):
+        if i % 4 == 0:
+            lines.append(f"  ; section {i // 4}: {' '.join(rng.choice(['load', 'store', 'add', 'the', 'value', 'into', 'R1']) for _ in range(8))}")
+        lines.append(f"        {random_instruction(rng, []):<24}; R{rng.randrange(16)} = 0x{rng.randrange(1 << 16):X} step {i}")
+    lines.append("        halt")
+    return "\n".join(lines) + "\n"
+
+
+# a short loop over tables of word data
+def word_table_program(rng: random.Random, table_count: int = 8, table_size: int = 48) -> str:
+    lines = ["        org 0", "        ldi R1, table0", "loop:   ld R2, 0(R1)", "        addi R1, R1, 1",
+             "        brnz R2, loop", "        halt"]
+    for table in range(table_count):
+        lines.append(f"        org {0x40 + table * table_size}")
+        lines.append(f"table{table}:")
+        for _ in range(table_size):
+            value = rng.getrandbits(31)
+            lines.append(f"        word 0x{value:X}" if rng.random() < 0.5 else f"        word {value}")
+    return "\n".join(lines) + "\n"
+
+
+# the same tables as word lists, with fill and space between them
+def data_list_program(rng: random.Random, table_count: int = 8, table_size: int = 48) -> str:
+    lines = ["        org 0", "        ldi R1, table0", "loop:   ld R2, 0(R1)", "        addi R1, R1, 1",
+             "        brnz R2, loop", "        halt", "        space 8", "        fill 8, -1"]
+    for table in range(table_count):
+        lines.append(f"        org {0x40 + table * table_size}")
+        values = [rng.getrandbits(31) for _ in range(table_size)]
+        if rng.random() < 0.5:
+            lines.append(f"table{table}: words {', '.join(f'0x{value:X}' for value in values)}")
+        else:
+            lines.append(f"table{table}: words {', '.join(str(value) for value in values)}")
+    return "\n".join(lines) + "\n"
+
+
+# code and data spread over many org blocks, like the lab phase programs
+def org_block_program(rng: random.Random, block_count: int = 24, block_size: int = 16) -> str:
+    lines = []
+    for block in range(block_count):
+        lines.append(f"        ORG {block * (block_size + 4)}   ; block {block}")
+        lines.append(f"sub{block}:")
+        for _ in range(block_size - 2):
+            lines.append(f"        {random_instruction(rng, [f'sub{block}'])}")
+        lines.append(f"        word 0x{rng.getrandbits(16):X}")
+        lines.append("        jr R12")
+    return "\n".join(lines) + "\n"
+
+
+# equ constants and macros with local labels, expanded many times
+def macro_program(rng: random.Random, expansion_count: int = 96) -> str:
+    lines = ["COUNT   equ 8", "STEP    equ -1",
+             "        macro countdown reg, start", "        addi reg, R0, start",
+             "loop:   addi reg, reg, STEP", "        brnz reg, loop", "        endm",
+             "        macro swap a, b", "        add a, a, b", "        sub b, a, b",
+             "        sub a, a, b", "        endm", "        org 0"]
+    for _ in range(expansion_count):
+        a, b = rng.sample(range(1, 8), 2)
+        lines.append(f"        countdown R{a}, COUNT" if rng.random() < 0.5 else f"        swap R{a}, R{b}")
+    lines.append("        halt")
+    return "\n".join(lines) + "\n"
+
+
+def expression_program(rng: random.Random, record_count: int = 48, record_size: int = 4) -> str:
+    lines = ["        org 0", "        ldi R1, records", f"        ldi R2, (end - records) / {record_size}"]
+    for record in range(record_count):
+        field = rng.randrange(record_size)
+        lines.append(f"        ld R3, records + {record} * {record_size} + {field}(R0)")
+        lines.append(f"        addi R4, R3, lo(records + {record_size} * {record}) >> 1")
+        lines.append("        brmi R3, . + 2")
+        lines.append("        addi R2, R2, -1")
+    lines.append("        halt")
+    lines.append("records:")
+    for record in range(record_count):
+        values = [str(rng.randrange(-1000, 1000)) for _ in range(record_size - 1)]
+        lines.append(f"        words {', '.join(values)}, records + {record} * {record_size}")
+    lines.append("end:    word hi(end) | lo(end)")
+    return "\n".join(lines) + "\n"
+
+
+def read_static_program(name: str) -> str:
+    with open(os.path.join(REPO_DIRECTORY, "static", f"{name}.s"), encoding="utf8") as f:
+        return f.read()
+
+
+def build_workloads(seed: int) -> dict[str, str]:
+    rng = random.Random(seed)
+    return {
+        "phase3_program": read_static_program("phase3_program"),
+        "phase4_program": read_static_program("phase4_program"),
+        "full_image": full_image_program(rng),
+        "branch_heavy": branch_heavy_program(rng),
+        "comment_heavy": comment_heavy_program(rng),
+        "word_tables": word_table_program(rng),
+        "org_blocks": org_block_program(rng),
+        "data_lists": data_list_program(rng),
+        "macros": macro_program(rng),
+        "expressions": expression_program(rng),
+    }
+
+
+# programs whose warnings have to come back from an incremental assembler
+# even for lines it didn't encode again
+WARNING_PROGRAMS = {
+    "unsigned_constants": "\n".join([
+        "LIMIT   equ 0x40001", "        org 0", "        addi R1, R1, 0x40000", "        ldi R2, 0x7FFFF",
+        "loop:   brzr R1, loop", "        word 0x80000000", "        words 0x80000000, 0xFFFFFFFF, 1",
+        "        andi R3, R3, LIMIT", "        halt", ""]),
+    "forward_labels": "\n".join([
+        "        org 0", "        ld R1, table(R0)", "        word 0xFFFFFFFF", "        brnz R1, end",
+        "table:  word 0x80000001", "end:    addi R2, R2, 0x50000", "        halt", ""]),
+}
+
+
+def assemble_or_error(assembler: SRC_ASM.Assembler, code: str, incremental: SRC_ASM.IncrementalAssembler | None = None) -> tuple:
+    try:
+        result = assembler.assemble_to("mem", code, incremental=incremental)
+    except Exception as e:
+        return "error", str(e)
+    return result.output, result.warnings
+
+
+# assembles every revision of each program fresh and incrementally, with the
+# revisions in order so later ones reuse the words of earlier ones. returns
+# the (program, revision) of every revision where the two differ
+def check_incremental(programs: dict[str, str]) -> list[tuple[str, int]]:
+    assembler = SRC_ASM.Assembler()
+    mismatches = []
+    for name, code in programs.items():
+        incremental = SRC_ASM.IncrementalAssembler()
+        # the same program, an edit that changes nothing else and one that
+        # moves every address
+        revisions = [code, code, f"{code}\n; edited", f"        nop\n{code}", code]
+        for revision, revision_code in enumerate(revisions):
+            if assemble_or_error(assembler, revision_code) != assemble_or_error(assembler, revision_code, incremental):
+                mismatches.append((name, revision))
+    return mismatches
+
+
+# a negative word has to be written as its two's complement in every output,
+# or the board and the disassembler can't read it. returns the outputs that
+# got word -1 wrong
+def check_negative_words() -> list[str]:
+    assembler = SRC_ASM.Assembler()
+    code = "        word -1\n"
+    wrong = []
+    if "@0 FFFFFFFF" not in assembler.assemble_to("mem", code).output:
+        wrong.append("mem")
+    if "0: FFFFFFFF;" not in assembler.assemble_to("mif", code).output:
+        wrong.append("mif")
+    sparse_output = json.loads(json.dumps(SRC_ASM.sparse_output(assembler.assemble(code).program)))
+    if sparse_output["words"] != [0xFFFFFFFF]:
+        wrong.append("sparse_output")
+    return wrong
+
+
+# runs the function enough times per sample to take a measurable amount of time
+def time_function(function: Callable[[], object], samples: int, min_sample_time: float) -> dict[str, float | int]:
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_sample_time:
+            break
+        loops *= 2
+
+    times = [elapsed / loops]
+    for _ in range(samples - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        times.append((time.perf_counter() - start) / loops)
+    return {
+        "min_us": min(times) * 1e6,
+        "median_us": statistics.median(times) * 1e6,
+        "loops": loops,
+        "samples": samples,
+    }
+
+
+def get_app_client():
+    try:
+        import app
+    except ImportError as e:  # flask isn't needed for the other phases
+        print(f"Skipping the /assemble round trip: {e}")
+        return None
+    return app.app.test_client()
+
+
+def benchmark_workload(code: str, client, samples: int, min_sample_time: float) -> dict[str, dict[str, float | int]]:
+    # the passes are timed with the preprocessor, like assemble_with_lines
+    labels, instructions, *_ = SRC_ASM.first_pass(*SRC_ASM.preprocess(code)[:2])
+    program = SRC_ASM.assembly_to_program(code)
+
+    phases: dict[str, Callable[[], object]] = {
+        "first_pass": lambda: SRC_ASM.first_pass(*SRC_ASM.preprocess(code)[:2]),
+        "second_pass": lambda: SRC_ASM.second_pass(labels, instructions),
+        "single_pass": lambda: SRC_ASM.single_pass(*SRC_ASM.preprocess(code)[:2]),
+        "assembly_to_file_mem": lambda: SRC_ASM.assembly_to_file("mem", code),
+        "assembly_to_file_mif": lambda: SRC_ASM.assembly_to_file("mif", code),
+        "build_program": lambda: SRC_ASM.assembly_to_program(code),
+        "mem_format": lambda: SRC_ASM.mem_format(program),
+        "mif_format": lambda: SRC_ASM.mif_format(program),
+        "lst_format": lambda: "".join(SRC_ASM.lst_chunks(program)),
+    }
+    if client is not None:
+        counter = iter(range(1 << 62))
+
+        # a comment unique to each request keeps the response cache and the
+        # ETag check from skipping the assembler
+        def round_trip():
+            response = client.post("/assemble", data={
+                "code": f"{code}\n; request {next(counter)}", "format": "mem"})
+            assert response.status_code == 200 and "output" in response.json
+
+        def cached_round_trip():
+            response = client.post("/assemble", data={"code": code, "format": "mem"})
+            assert response.status_code == 200 and "output" in response.json
+
+        phases["assemble_request"] = round_trip
+        phases["assemble_request_cached"] = cached_round_trip
+
+    return {phase: time_function(function, samples, min_sample_time)
+            for phase, function in phases.items()}
+
+
+def get_metadata(seed: int) -> dict[str, str | int]:
+    with open(SRC_ASM.__file__, "rb") as f:
+        assembler_version = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "assembler_version": assembler_version,
+        "seed": seed,
+    }
+
+
+# returns the (workload, phase, ratio) of every phase that got slower by more
+# than the threshold, comparing medians
+def compare_results(baseline: dict, results: dict, threshold: float) -> list[tuple[str, str, float]]:
+    regressions = []
+    for workload, phases in results["results"].items():
+        for phase, timing in phases.items():
+            baseline_timing = baseline["results"].get(workload, {}).get(phase)
+            if baseline_timing is None:
+                continue
+            ratio = timing["median_us"] / baseline_timing["median_us"]
+            marker = "  REGRESSION" if ratio > 1 + threshold else ""
+            print(f"{workload:<16} {phase:<26} {baseline_timing['median_us']:>10.1f} -> {timing['median_us']:>10.1f} us  x{ratio:.2f}{marker}")
+            if marker:
+                regressions.append((workload, phase, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='ELEC374 MiniSRC Assembler benchmarks',
+        description='Times each assembler phase on generated and lab programs and saves the results as JSON')
+    parser.add_argument('-o', '--output')  # results file
+    parser.add_argument('-c', '--compare')  # earlier results file to compare with
+    parser.add_argument('-w', '--workload', action='append')  # only these workloads
+    parser.add_argument('--seed', type=int, default=374)
+    parser.add_argument('--samples', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.05)  # seconds per sample
+    parser.add_argument('--threshold', type=float,
+                        default=0.10)  # slowdown reported as a regression
+    parser.add_argument('--no-app', action='store_true')  # skip the /assemble round trip
+    parser.add_argument('--no-check', action='store_true')  # skip comparing incremental and fresh assembly
+    args = parser.parse_args()
+
+    workloads = build_workloads(args.seed)
+    if args.workload:
+        unknown = set(args.workload) - workloads.keys()
+        if unknown:
+            parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+        workloads = {name: workloads[name] for name in args.workload}
+
+    # timings of an assembler that gives the wrong output aren't worth saving
+    if not args.no_check:
+        mismatches = check_incremental({**workloads, **WARNING_PROGRAMS})
+        for name, revision in mismatches:
+            print(f"{name}: revision {revision} assembles differently incrementally")
+        if mismatches:
+            sys.exit(1)
+        print("Incremental assembly matches fresh assembly, with the same warnings")
+        wrong_outputs = check_negative_words()
+        for output in wrong_outputs:
+            print(f"{output}: word -1 isn't written as FFFFFFFF")
+        if wrong_outputs:
+            sys.exit(1)
+
+    client = None if args.no_app else get_app_client()
+
+    results = {"metadata": get_metadata(args.seed), "results": {}}
+    for name, code in workloads.items():
+        print(f"{name} ({len(code.splitlines())} lines)")
+        results["results"][name] = benchmark_workload(
+            code, client, args.samples, args.min_time)
+        for phase, timing in results["results"][name].items():
+            print(f"  {phase:<26} {timing['median_us']:>10.1f} us")
+
+    output_filename = args.output or os.path.join(
+        REPO_DIRECTORY, "benchmarks", "results",
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+    with open(output_filename, "w", encoding="utf8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {output_filename}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            baseline = json.load(f)
+        if baseline["metadata"].get("seed") != args.seed:
+            print("Warning: the results were made with a different seed")
+        regressions = compare_results(baseline, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} phases are more than {args.threshold:.0%} slower")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import os
+
+# requests are taken by threads and the assembling is done by the worker
+# pool in app.py (WORKERS, WORK_QUEUE_DEPTH and WORK_TIMEOUT), so a slow
+# submission doesn't hold up everyone else's
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_PROCESSES', 1))
+threads = int(os.environ.get('WEB_THREADS', 32))
+# connections held open by clients past this wait to be accepted
+backlog = int(os.environ.get('WEB_BACKLOG', 256))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 10
+keepalive = 5